@@ -19,55 +19,303 @@
 # for us, minimiser for them).                                                                   #
 #                                                                                                #
 # Algorithms and data structures employed:                                                       #
-# - Alpha beta search                                                                            #
+# - Alpha beta search, as a negamax principal variation search with aspiration windows           #
+#   (--search alphabeta for plain alpha beta)                                                    #
+# - Monte Carlo tree search as an alternative engine, with batched NumPy playouts (mcts.py,      #
+#   --search mcts)                                                                               #
+# - Exact win/loss/draw endgame solver once few cells are empty, its results reused by search    #
 # - Heuristic is a modified version of the week 5 tute one                                       #
-# - Maintain possible board moves as a dictionary for efficiency                                 #
-# - Boards are by a 2D arrays, board[i][j] where i is which 3x3 board, j is which tile inside    #
+# - Heuristic weights can be fitted to the results of recorded games, Texel style, by tune.py,   #
+#   which scores millions of positions at once with a NumPy version of the heuristic (--weights) #
+# - Engine objects hold a search's tables and GameState objects hold a game, so one process can  #
+#   play many servt games at once (-p with several ports) with a pool of processes searching     #
+# - Opening book of deeply searched early positions, stored by symmetry canonical key (book.py)  #
+# - Pondering, searching our replies to each of their moves while they think (--ponder)          #
+# - Every move of every game recorded to fixed width binary files (--record), which record.py    #
+#   maps as a NumPy array for building books, test positions and tuning                          #
+# - Root splitting over a pool of worker processes (--workers) to use more than one core         #
+# - Move ordering: table move, wins and blocks, killer moves, then the history heuristic         #
+# - Threat masks: wins are taken and moves that give them a win skipped without searching, and   #
+#   forced moves are played straight away                                                        #
+# - Transposition table of searched positions, keyed by Zobrist hashes and kept between moves    #
+# - Positions keyed by their canonical form under the 8 symmetries, so the table, book and       #
+#   solver share results between symmetric positions, and the root searches symmetric moves      #
+#   only once                                                                                    #
+# - Boards are bitboards, one 9 bit mask per player per 3x3 board, bits[p][i] where i is which   #
+#   3x3 board and bit j-1 is tile j inside it. Wins and empty tiles come from 512 entry tables   #
 #                                                                                                #
 # Design decisions made:                                                                         #
 # - Originally we used copy.deepcopy() to create each board state one by one, however deepcopy   #
 # requires some time and slowed our program down. Hence, instead, we would make a move on the    #
 # current board and after evaluation, undo the moves from the current board.                     #
 # - Heuristic used to be a double for loop to go over every board. Instead we opted for a        #
-# single for loop with a bunch of if statements to make it slightly quicker.                     #
-# - Depth Limit is increased as we go deeper into the game as less children nodes need to be     #
-# expanded, this helps reduce unnecessary computation in the beginning to allow our program      #
-# to run faster and as we go towards the end, better evaluation of positions.                    #
+# single for loop with a bunch of if statements to make it slightly quicker. Now the counts for  #
+# every 3x3 board are precomputed over all 3^9 boards and kept as running totals by make/unmake, #
+# so evaluating a leaf is a few shifts instead of rescanning all 9 boards.                       #
+# - Depth Limit used to go up by 2 every 21 moves. Now we use iterative deepening (depth 1, 2,   #
+# 3...) against a deadline worked out from our clock, which we track the same way servt does,    #
+# so we use the time we have without ever losing on time.                                        #
 # - We modified the week 5 tute heuristic as we needed to understand how good our position is    #
 # taking in a count of all 9 boards rather than a sub 3x3 board. Evaluating just a 3x3 board     #
 # would cause our AI to evaluate a move as good if it helped us make 2 in a row, but lose on     #
 # the very next turn.                                                                            #
 # - Used Alpha beta over MCTS as MCTS isn't able to simulate enough games to identify the        #
-# best possible move as we have a short time limit.                                              #
+# best possible move as we have a short time limit. That holds for playouts one at a time in     #
+# python, so mcts.py plays them thousands at once as NumPy arrays, and can be played against     #
+# alpha beta under the same clock with match.py.                                                 #
+# - The boards used to be a 10x10 numpy array, but indexing single numpy elements is far slower  #
+# than plain python ints, so the search now runs on bitboards with make/unmake.                  #
+# - All the game and search state used to be module globals, so every game needed a process of   #
+# its own. It now lives in GameState and Engine objects, and an asyncio front end plays the      #
+# games of many servers from one process, their searches shared over a pool of workers.          #
 # - Used Python as it's the easiest language to code this project in, however, we understand     #
 # the drawbacks of python being incredibly slow.                                                 #
 ##################################################################################################       
 
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import mmap
+import multiprocessing
+import os
+import random
 import socket
+import struct
 import sys
-import numpy as np
+import threading
+import time
+from array import array
 
 # A board cell can hold:
 #   0 - Empty
 #   1 - I played here
 #   2 - They played here
+# Cells are stored as bitboards (see Board below) rather than a 10x10 array,
+# get() turns a cell back into one of the values above.
 
-# The boards are of size 10 because index 0 isn't used
-boards = np.zeros((10, 10), dtype="int8")
 s = [".","X","O"]
-# Current board to play in
-curr = 0
-# Number of moves played, used to increase depth_limit
-num_moves_made = 0
-# Depth Limit, how many levels of child boards to create
-depth_limit = 5
+# Score of a won position, used instead of infinity so it fits in the transposition table
+WIN = 1000000
+# Bound of a full search window, above any score
+INF = WIN + 1
+
+#########################################################################
+############################## Bitboards ################################
+#########################################################################
+
+# Bit used for each cell of a 3x3 board, cell j is bit j-1 (index 0 isn't used)
+CELL = [0] + [1 << (j - 1) for j in range(1, 10)]
+
+# The 8 lines that win a 3x3 board
+LINES = [CELL[a] | CELL[b] | CELL[c] for a, b, c in (
+    (1,2,3), (4,5,6), (7,8,9),  # rows
+    (1,4,7), (2,5,8), (3,6,9),  # columns
+    (1,5,9), (3,5,7))]          # diagonals
+
+# Lookup tables over every possible 9 bit mask of a 3x3 board
+# WINNING[mask] -> True if the mask holds a full line
+WINNING = [any(mask & line == line for line in LINES) for mask in range(512)]
+# EMPTY[mask] -> tuple of the cells not in the (occupied) mask, in 1..9 order
+EMPTY = [tuple(j for j in range(1, 10) if not mask & CELL[j]) for mask in range(512)]
+# POPCOUNT[mask] -> number of cells in the mask
+POPCOUNT = [bin(mask).count("1") for mask in range(512)]
+# THREATS[mask] -> mask of the cells outside mask that would complete one of its
+# lines, so THREATS[mine] & empty cells are the moves that win the board now
+THREATS = [sum(CELL[j] for j in range(1, 10) if not mask & CELL[j] and WINNING[mask | CELL[j]])
+           for mask in range(512)]
+
+# Each 3x3 board also has a base 3 code, the sum of cell value * 3^(j-1).
+# POW3[j] -> what one unit of cell j adds to the code
+POW3 = [0] + [3 ** (j - 1) for j in range(1, 10)]
+
+# Ways to win a 3x3 board, lines with two of mine and the third cell empty
+# Params: mine -> my 9 bit mask, theirs -> their 9 bit mask
+# Returns: number of such lines
+def count_twos(mine, theirs):
+    twos = 0
+    for line in LINES:
+        if not theirs & line and POPCOUNT[mine & line] == 2:
+            twos += 1
+    return twos
+
+# Zobrist keys, ZOBRIST[p][i][j] is xored into the hash when player p holds
+# cell j of board i and ZOBRIST_TURN[p][i] marks player p having to play in board i.
+# Fixed seed so keys (and anything saved with them) are the same every run.
+_zobrist_rng = random.Random(3411)
+ZOBRIST = [[[_zobrist_rng.getrandbits(64) for j in range(10)] for i in range(10)]
+           for p in range(3)]
+ZOBRIST_TURN = [[_zobrist_rng.getrandbits(64) for i in range(10)] for p in range(3)]
+
+# Builds the heuristic table over all 3^9 codes of a 3x3 board.
+# Each entry packs the board's part of calc_h into one int, a byte per field:
+#   bits 0-7   -> number of ways we can win      bit 8  -> 1 if that's > 0
+#   bits 16-23 -> number of ways they can win    bit 24 -> 1 if that's > 0
+# Every field of a sum of entries stays far below 256, so summing the entries
+# over the 9 boards gives all four totals of calc_h at once.
+def build_h_table():
+    table = []
+    for code in range(3 ** 9):
+        mine = 0
+        theirs = 0
+        for j in range(1, 10):
+            cell = code // POW3[j] % 3
+            if cell == 1:
+                mine |= CELL[j]
+            elif cell == 2:
+                theirs |= CELL[j]
+        us = count_twos(mine, theirs)
+        them = count_twos(theirs, mine)
+        table.append(us | (us > 0) << 8 | them << 16 | (them > 0) << 24)
+    return table
+
+H_TABLE = build_h_table()
+
+# Bitboard state of the 9x9 board.
+# bits[p][i] is a 9 bit mask of the cells player p holds in 3x3 board i,
+# bits[0] and bits[p][0] aren't used so indices match the cell values above.
+# codes[i] is the base 3 code of board i and h is the sum of H_TABLE over the
+# codes, both kept up to date by make/unmake so calc_h never rescans a board.
+# hashes is the Zobrist hash of the cells in each of the 8 symmetric versions
+# of the board (see Symmetry), packed into one int, which key() turns into
+# the position's table key.
+class Board:
+    __slots__ = ("bits", "codes", "h", "hashes")
+
+    def __init__(self):
+        self.bits = [None, [0] * 10, [0] * 10]
+        self.codes = [0] * 10
+        self.h = H_TABLE[0] * 9
+        self.hashes = 0
+
+    # Put player on a cell, the cell must be empty
+    # Params: boardnum -> 3x3 board, cell -> cell in that board, player -> 1 or 2
+    def make(self, boardnum, cell, player):
+        self.bits[player][boardnum] |= CELL[cell]
+        codes = self.codes
+        old = codes[boardnum]
+        new = old + player * POW3[cell]
+        codes[boardnum] = new
+        self.h += H_TABLE[new] - H_TABLE[old]
+        self.hashes ^= ZOBRIST_SYMMETRIC[player][boardnum][cell]
+
+    # Take back a move made with make()
+    # Params: boardnum -> 3x3 board, cell -> cell in that board, player -> 1 or 2
+    def unmake(self, boardnum, cell, player):
+        self.bits[player][boardnum] ^= CELL[cell]
+        codes = self.codes
+        old = codes[boardnum]
+        new = old - player * POW3[cell]
+        codes[boardnum] = new
+        self.h += H_TABLE[new] - H_TABLE[old]
+        self.hashes ^= ZOBRIST_SYMMETRIC[player][boardnum][cell]
+
+    # Returns: a copy of the board that can be changed independently
+    def copy(self):
+        board = Board.__new__(Board)
+        board.bits = [None, self.bits[1][:], self.bits[2][:]]
+        board.codes = self.codes[:]
+        board.h = self.h
+        board.hashes = self.hashes
+        return board
+
+    # Returns: tuple of the empty cells in a 3x3 board
+    def moves(self, boardnum):
+        bits = self.bits
+        return EMPTY[bits[1][boardnum] | bits[2][boardnum]]
+
+    # Returns: who holds a cell, 0 if empty, else the player
+    def get(self, boardnum, cell):
+        bit = CELL[cell]
+        if self.bits[1][boardnum] & bit:
+            return 1
+        if self.bits[2][boardnum] & bit:
+            return 2
+        return 0
+
+    # The position's key, the smallest Zobrist key of its 8 symmetric
+    # versions, so all of them share one key (see Symmetry)
+    # Params: player -> player to move, boardnum -> board they play in
+    # Returns: key -> the key, symmetry -> the s that turns the position
+    #          into the version it is the key of
+    def key(self, player, boardnum):
+        keys = SYMMETRIC_KEYS.unpack(
+            (self.hashes ^ ZOBRIST_TURN_SYMMETRIC[player][boardnum]).to_bytes(64, "little"))
+        key = min(keys)
+        return key, keys.index(key)
+
+#########################################################################
+########################### End of Bitboards ############################
+#########################################################################
+
+#########################################################################
+############################### Symmetry ################################
+#########################################################################
+
+# The game is the same after any of the 8 rotations and reflections of the
+# 3x3 grid, applied to the big board and to every 3x3 board inside it at once.
+# SYMMETRY[s][j] -> where cell (or board) j goes under symmetry s, 0 is the identity
+# UNSYMMETRY[s][j] -> the cell that goes to j, undoing symmetry s
+
+def build_symmetries():
+    symmetries = []
+    for flip in (False, True):
+        for turns in range(4):
+            perm = [0]
+            for j in range(1, 10):
+                row, col = divmod(j - 1, 3)
+                if flip:
+                    col = 2 - col
+                for t in range(turns):
+                    row, col = col, 2 - row
+                perm.append(row * 3 + col + 1)
+            symmetries.append(perm)
+    return symmetries
+
+SYMMETRY = build_symmetries()
+UNSYMMETRY = [[perm.index(j) for j in range(10)] for perm in SYMMETRY]
+
+# Board.hashes keeps the Zobrist hash of all 8 symmetric versions of the board
+# at once, version s in bits 64*s to 64*s+63 of one int, so make/unmake
+# update them all with one xor.
+# ZOBRIST_SYMMETRIC[p][i][j] -> ZOBRIST[p][i][j] moved by each symmetry, packed
+# ZOBRIST_TURN_SYMMETRIC[p][i] -> ZOBRIST_TURN[p][i] moved by each symmetry, packed
+# Board.key() takes the smallest of the 8 keys, the key of the position's
+# canonical form. The transposition table, opening book and solved positions
+# are all keyed by it, and the move stored with a key is the one for the
+# canonical form, turned back with UNSYMMETRY when it's used.
+
+def pack_symmetric(key):
+    return sum(key(perm) << 64 * s for s, perm in enumerate(SYMMETRY))
+
+ZOBRIST_SYMMETRIC = [[[pack_symmetric(lambda perm: ZOBRIST[p][perm[i]][perm[j]])
+                       for j in range(10)] for i in range(10)] for p in range(3)]
+ZOBRIST_TURN_SYMMETRIC = [[pack_symmetric(lambda perm: ZOBRIST_TURN[p][perm[i]])
+                           for i in range(10)] for p in range(3)]
+SYMMETRIC_KEYS = struct.Struct("<8Q")
+
+# Params: board -> board state, s -> symmetry
+# Returns: a new board, the position moved by symmetry s
+def transform(board, s):
+    moved = Board()
+    perm = SYMMETRY[s]
+    for p in (1, 2):
+        for i in range(1, 10):
+            for j in EMPTY[511 ^ board.bits[p][i]]:
+                moved.make(perm[i], perm[j], p)
+    return moved
+
+#########################################################################
+############################ End of Symmetry ############################
+#########################################################################
 
 # Print a row of the board
 # This is just ported from game.c
 def print_board_row(board, a, b, c, i, j, k):
-    print(" "+s[board[a][i]]+" "+s[board[a][j]]+" "+s[board[a][k]]+" | " \
-             +s[board[b][i]]+" "+s[board[b][j]]+" "+s[board[b][k]]+" | " \
-             +s[board[c][i]]+" "+s[board[c][j]]+" "+s[board[c][k]])
+    get = board.get
+    print(" "+s[get(a,i)]+" "+s[get(a,j)]+" "+s[get(a,k)]+" | " \
+             +s[get(b,i)]+" "+s[get(b,j)]+" "+s[get(b,k)]+" | " \
+             +s[get(c,i)]+" "+s[get(c,j)]+" "+s[get(c,k)])
 
 # Print the entire board
 # This is just ported from game.c
@@ -85,346 +333,1290 @@ def print_board(board):
     print_board_row(board, 7,8,9,7,8,9)
     print()
 
+#########################################################################
+########################## Transposition Table ##########################
+#########################################################################
+
+# Results of positions already searched, keyed by Board.key().
+# The table is two flat arrays so its size is fixed: keys holds the 64 bit
+# keys and data the packed result for the same slot, 16 bytes per entry.
+# Slots come in buckets of two, a key can only live in its own bucket.
+# Entries are kept across moves, age tells this search's entries apart
+# from ones left over from earlier moves.
+
+# Bound types of a stored score
+EXACT = 0
+LOWER = 1  # real score >= stored score
+UPPER = 2  # real score <= stored score
+
+# Stored data packs: move (bits 0-3), bound (4-5), depth (8-15),
+# age (16-23) and score + SCORE_BIAS (24 up)
+SCORE_BIAS = 1 << 24
+
+# Default size of a table in megabytes
+TT_MB = 64
+# Replacement policies, see TranspositionTable
+TT_POLICIES = ("both", "depth", "always")
+
+class TranspositionTable:
+    __slots__ = ("mb", "policy", "keys", "data", "mask", "age")
+
+    # Allocate an empty table
+    # Params: mb -> size in megabytes, a hard cap
+    #         policy -> how a bucket chooses which entry to replace:
+    #   "both"   -> first slot keeps the deepest result, second always takes the newest
+    #   "depth"  -> both slots keep the deepest results
+    #   "always" -> both slots take the newest results
+    def __init__(self, mb=TT_MB, policy="both"):
+        self.mb = mb
+        self.policy = policy
+        # Largest power of two number of 32 byte buckets that fits in mb
+        buckets = 1
+        while buckets * 2 * 32 <= mb * 2**20:
+            buckets *= 2
+        self.keys = array("Q", bytes(16 * buckets))
+        self.data = array("q", bytes(16 * buckets))
+        self.mask = buckets - 1
+        self.age = 0
+
+    # Start a new search, older entries become free to replace
+    def new_search(self):
+        self.age = (self.age + 1) & 0xff
+
+    # Look up a position
+    # Params: key -> position key
+    # Returns: packed data of the entry, None if not stored
+    def probe(self, key):
+        keys = self.keys
+        i = (key & self.mask) << 1
+        if keys[i] == key:
+            return self.data[i]
+        if keys[i + 1] == key:
+            return self.data[i + 1]
+        return None
+
+    # Store a search result
+    # Params: key -> position key, depth -> depth searched below the position,
+    #         bound -> EXACT/LOWER/UPPER, score -> score found, move -> best move or 0
+    def store(self, key, depth, bound, score, move):
+        keys = self.keys
+        tt_data = self.data
+        age = self.age
+        i = (key & self.mask) << 1
+        data = (score + SCORE_BIAS) << 24 | age << 16 | depth << 8 | bound << 4 | move
+        if keys[i + 1] == key:
+            i += 1
+        elif keys[i] != key:
+            old = tt_data[i]
+            stale = (old >> 16 & 0xff) != age
+            if self.policy == "both":
+                if not stale and depth < (old >> 8 & 0xff):
+                    i += 1
+            elif self.policy == "depth":
+                # Replace the stale or shallower of the two, keep both if deeper
+                other = tt_data[i + 1]
+                if (other >> 16 & 0xff) != age or (not stale and (other >> 8 & 0xff) < (old >> 8 & 0xff)):
+                    i += 1
+                    old = other
+                    stale = (old >> 16 & 0xff) != age
+                if not stale and depth < (old >> 8 & 0xff):
+                    return
+            else:
+                # Newest in the first slot, the one before it in the second
+                keys[i + 1] = keys[i]
+                tt_data[i + 1] = old
+        keys[i] = key
+        tt_data[i] = data
+
+#########################################################################
+###################### End of Transposition Table #######################
+#########################################################################
+
+#########################################################################
+################################ Clock ##################################
+#########################################################################
+
+# Seconds kept back for the network and the server's rounding
+SAFETY_MARGIN = 0.3
+# The time we have banked is spread over this many moves
+MOVES_TO_GO = 15
+# Don't start another depth once this share of the move's time is used,
+# it would take several times longer than the last one to finish
+DEEPEN_SHARE = 0.4
+# The search looks at the clock whenever nodes & CHECK_MASK is 0, about
+# every 10ms, and more often while pondering, see Pondering
+CHECK_MASK = 1023
+PONDER_CHECK_MASK = 63
+# Seconds between thread switches while pondering, Python's default is 5ms
+PONDER_SWITCH = 0.0005
+
+# Raised inside the search when the move's time is up
+class SearchTimeout(Exception):
+    pass
+
+# Our clock for one game, counted the way servt counts it
+class Clock:
+    __slots__ = ("seconds_initially", "seconds_per_move", "time_left", "move_start")
+
+    # Params: seconds_initially, seconds_per_move -> what the server gives us,
+    #         the defaults are servt.c's, -t overrides them
+    def __init__(self, seconds_initially=30, seconds_per_move=2):
+        self.seconds_initially = seconds_initially
+        self.seconds_per_move = seconds_per_move
+        # When the current move request arrived
+        self.move_start = 0
+        self.new_game()
+
+    # Reset at the start of a game, servt starts us with seconds_initially
+    # less the seconds_per_move it adds for our first move
+    def new_game(self):
+        self.time_left = self.seconds_initially - self.seconds_per_move
+
+    # Called when the server asks for a move, it adds seconds_per_move to our clock
+    def start_move(self):
+        self.time_left += self.seconds_per_move
+        self.move_start = time.time()
+
+    # Called once our move is sent, takes the time we used off our clock
+    def end_move(self):
+        self.time_left -= time.time() - self.move_start
+
+    # Returns: seconds we can spend on this move
+    def move_budget(self):
+        banked = max(self.time_left - self.seconds_per_move, 0)
+        budget = self.seconds_per_move + banked / MOVES_TO_GO
+        return max(min(budget, self.time_left) - SAFETY_MARGIN, 0.05)
+
+#########################################################################
+############################# End of Clock ##############################
+#########################################################################
+
+#########################################################################
+############################### Telemetry ###############################
+#########################################################################
+
+# With --telemetry every move we make is written out as one line of JSON:
+#   move_number, board, move       -> the move we made, board is where we played it
+#   port                           -> port of the game's server
+#   source                         -> "search", "ponder" (carried on from pondering), "book"
+#                                     or "solver" (a proven win or draw, depth is the cells left)
+#                                     or "forced" (a win, every move losing, or the only move
+#                                     that doesn't lose, whose score is null, all unsearched)
+#                                     or "mcts" (score is the move's share of playout wins,
+#                                     depth how deep the tree goes, nodes count playouts)
+#   score, depth                   -> score and depth of the deepest finished search
+#   nodes, leaves                  -> nodes searched (not counting leaves), leaf evaluations
+#   cutoff_rate, first_cutoff_rate -> share of nodes that cut off, and share of
+#                                     cutoffs made by the first move tried
+#   branching                      -> effective branching factor, nodes of the last
+#                                     depth over nodes of the one before it
+#   seconds, budget, time_left     -> time taken, time we allowed, our clock after the move
+#   iterations                     -> for each depth finished: its move, score and nodes,
+#                                     and the seconds since the move started
+# The counters are plain integer adds, so they are always kept, and nothing
+# else is done unless telemetry is on.
+
+# Builds the record of a move we are making
+# Params: stats -> Engine.stats() of the search that chose it,
+#         game -> GameState, with the move counted but not yet placed,
+#         move -> cell we are playing
+# Returns: the record, ready for json.dumps
+def telemetry_record(stats, game, move):
+    iterations = stats["iterations"]
+    branching = 0
+    if len(iterations) > 1 and iterations[-2]["nodes"]:
+        branching = iterations[-1]["nodes"] / iterations[-2]["nodes"]
+    nodes = stats["nodes"]
+    cutoffs = stats["cutoffs"]
+    clock = game.clock
+    return {
+        "move_number": game.moves_made,
+        "board": game.curr,
+        "move": move,
+        "port": game.port,
+        "source": stats.get("source"),
+        "score": stats.get("score"),
+        "depth": stats.get("depth"),
+        "nodes": nodes,
+        "leaves": stats["leaves"],
+        "cutoff_rate": round(cutoffs / nodes, 4) if nodes else 0,
+        "first_cutoff_rate": round(stats["first_cutoffs"] / cutoffs, 4) if cutoffs else 0,
+        "branching": round(branching, 3),
+        "seconds": round(time.time() - clock.move_start, 4),
+        "budget": round(clock.move_budget(), 4),
+        "time_left": round(clock.time_left - (time.time() - clock.move_start), 4),
+        "iterations": iterations,
+    }
+
+#########################################################################
+############################ End of Telemetry ###########################
+#########################################################################
+
+#########################################################################
+############################# Game Records ##############################
+#########################################################################
+
+# Every move of every game, ours and theirs, is appended to a binary file of
+# fixed width records, one file per process in --record's directory.
+# record.py maps a directory of them as a NumPy array.
+#
+# File layout, all little endian:
+#   header  -> RECORD_MAGIC, then the size of a record (uint32)
+#   records -> game (uint64, random id of the game),
+#              bits of player 1 then player 2 in boards 1..9 (9 uint16 each),
+#                  the position before the move, player 1 is us
+#              board, cell, player (1 us, 2 them), ply (moves before this one),
+#              source (index into RECORD_SOURCES), depth, result, 1 unused (uint8),
+#              score (int32), nodes (uint32), seconds (float32)
+# result is RECORD_UNFINISHED until the game ends, then every record of the
+# game is rewritten in place with RECORD_WIN, RECORD_DRAW or RECORD_LOSS
+# for us. Their moves and the first move servt makes for us have source "",
+# and a score of 0. Scores are the engine's, mcts ones are in thousandths.
+
+RECORD_MAGIC = b"UTTTRECS"
+RECORD_HEADER = struct.Struct("<8sI4x")
+RECORD = struct.Struct("<Q9H9HBBBBBBBxiIf")
+# Offset of result inside a record
+RECORD_RESULT = 50
+RECORD_SOURCES = ("", "search", "ponder", "book", "solver", "forced", "mcts")
+RECORD_UNFINISHED = 0
+RECORD_WIN = 1
+RECORD_DRAW = 2
+RECORD_LOSS = 3
+# Default directory, next to this file
+RECORD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "records")
+
+class Recorder:
+    __slots__ = ("path", "fd", "count")
+
+    # Start a new record file
+    # Params: directory -> where to put it, made if it doesn't exist
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "%s-%d.rec" % (time.strftime("%Y%m%d-%H%M%S"),
+                                                            os.getpid()))
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        os.write(self.fd, RECORD_HEADER.pack(RECORD_MAGIC, RECORD.size))
+        self.count = 0
+
+    # Append the record of one move
+    # Params: game -> GameState, before the move is placed, boardnum -> board
+    #         played in, cell -> cell played, player -> who played it,
+    #         stats -> Engine.stats() of our search, or None
+    # Returns: index of the record, for finish()
+    def write(self, game, boardnum, cell, player, stats):
+        bits = game.board.bits
+        ply = sum(POPCOUNT[bits[1][i] | bits[2][i]] for i in range(1, 10))
+        source = depth = score = nodes = 0
+        seconds = 0.0
+        if stats:
+            source = RECORD_SOURCES.index(stats.get("source", ""))
+            depth = min(stats.get("depth") or 0, 255)
+            score = stats.get("score") or 0
+            if isinstance(score, float):
+                score = round(score * 1000)
+            nodes = min(stats["nodes"], 0xffffffff)
+            seconds = time.time() - game.clock.move_start
+        os.pwrite(self.fd, RECORD.pack(game.game_id, *bits[1][1:], *bits[2][1:], boardnum,
+                                       cell, player, ply, source, depth, RECORD_UNFINISHED,
+                                       score, nodes, seconds),
+                  RECORD_HEADER.size + self.count * RECORD.size)
+        self.count += 1
+        return self.count - 1
+
+    # Fill in the result of a game
+    # Params: indices -> its records, result -> RECORD_WIN, RECORD_DRAW or RECORD_LOSS
+    def finish(self, indices, result):
+        for index in indices:
+            os.pwrite(self.fd, bytes([result]),
+                      RECORD_HEADER.size + index * RECORD.size + RECORD_RESULT)
+
+#########################################################################
+########################## End of Game Records ##########################
+#########################################################################
+
+#########################################################################
+############################ Move Ordering ##############################
+#########################################################################
+
+# Alpha beta prunes the most when the best move is searched first, so moves
+# are tried in this order:
+#   1. the best move stored in the transposition table (the last depth's pick)
+#   2. moves that win the 3x3 board, then moves that block their win there
+#   3. the two killer moves of this ply, the last moves to cause a cutoff here
+#   4. the rest by history, how often and how deep they have caused cutoffs
+# Both tables are kept between depths and between moves.
+
+# Ply limit, one more than the number of cells
+MAX_PLY = 82
+
+# Sort keys for the first three groups, above any history score
+ORDER_BEST = 1 << 60
+ORDER_WIN = 1 << 59
+ORDER_BLOCK = 1 << 58
+ORDER_KILLER = 1 << 57
+
+class MoveOrdering:
+    __slots__ = ("killers", "history")
+
+    def __init__(self):
+        # killers[ply] -> the two cells that last caused a cutoff at that ply
+        self.killers = [[0, 0] for ply in range(MAX_PLY + 2)]
+        # history[p][i][j] -> cutoff score of player p playing cell j of board i
+        self.history = [[[0] * 10 for i in range(10)] for p in range(3)]
+
+    # Get the tables ready for the next move's search.
+    # Our last search was two plies ago, so the killers move up two plies,
+    # and history is halved so what was learnt on this move counts more.
+    def new_search(self):
+        killers = self.killers
+        del killers[:2]
+        killers.extend([0, 0] for ply in range(2))
+        for tables in self.history[1:]:
+            for table in tables:
+                for j in range(1, 10):
+                    table[j] >>= 1
+
+    # Orders the moves of a node
+    # Params: board -> board state, boardnum -> 3x3 board to play in,
+    #         player -> player to move, children -> legal cells,
+    #         best -> transposition table move or 0, ply -> depth of the node
+    # Returns: the cells, best first
+    def order(self, board, boardnum, player, children, best, ply):
+        if len(children) < 2:
+            return children
+        mine = board.bits[player][boardnum]
+        theirs = board.bits[3 - player][boardnum]
+        killer1, killer2 = self.killers[ply]
+        hist = self.history[player][boardnum]
+        keys = [0] * 10
+        for c in children:
+            bit = CELL[c]
+            if c == best:
+                keys[c] = ORDER_BEST
+            elif WINNING[mine | bit]:
+                keys[c] = ORDER_WIN
+            elif WINNING[theirs | bit]:
+                keys[c] = ORDER_BLOCK
+            elif c == killer1:
+                keys[c] = ORDER_KILLER + 1
+            elif c == killer2:
+                keys[c] = ORDER_KILLER
+            else:
+                keys[c] = hist[c]
+        # sorted() is stable, equal keys keep the 1..9 order
+        return sorted(children, key=keys.__getitem__, reverse=True)
+
+    # Remember a move that caused a beta cutoff
+    # Params: player -> who played it, boardnum -> 3x3 board, cell -> cell played,
+    #         ply -> depth of the node, remaining -> depth searched below it
+    def add_cutoff(self, player, boardnum, cell, ply, remaining):
+        self.history[player][boardnum][cell] += remaining * remaining
+        killer = self.killers[ply]
+        if killer[0] != cell:
+            killer[1] = killer[0]
+            killer[0] = cell
+
+#########################################################################
+######################### End of Move Ordering ##########################
+#########################################################################
+
+#########################################################################
+############################# Opening Book ##############################
+#########################################################################
+
+# Best moves for early positions, searched deeply offline by book.py so the
+# first moves of a game cost a lookup instead of a search. Positions are
+# stored by Board.key() and the move is the one for the canonical form
+# (see Symmetry).
+#
+# File layout, all little endian:
+#   header  -> BOOK_MAGIC, then the number of entries (uint32)
+#   entries -> key (uint64), score (int32), move (uint8), depth (uint8), 2 unused,
+#              sorted by key so a lookup is a binary search
+# The file is mmap'd, nothing is read until a lookup needs it.
+
+BOOK_MAGIC = b"UTTTBOOK"
+BOOK_HEADER = struct.Struct("<8sI4x")
+BOOK_ENTRY = struct.Struct("<QiBB2x")
+# Default book, next to this file
+BOOK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.book")
+
+class Book:
+    __slots__ = ("path", "data", "size")
+
+    # Map a book file
+    # Params: path -> file written by book.py
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size = BOOK_HEADER.unpack_from(self.data, 0)
+        if magic != BOOK_MAGIC:
+            raise ValueError(path + " is not an opening book")
+
+    # Look the position up in the book
+    # Params: board -> board state, boardnum -> board we play in
+    # Returns: (move, score, depth) of the entry, None if it isn't in the book
+    def lookup(self, board, boardnum):
+        key, symmetry = board.key(1, boardnum)
+        low = 0
+        high = self.size
+        while low < high:
+            mid = (low + high) // 2
+            offset = BOOK_HEADER.size + mid * BOOK_ENTRY.size
+            found, score, move, depth = BOOK_ENTRY.unpack_from(self.data, offset)
+            if found < key:
+                low = mid + 1
+            elif found > key:
+                high = mid
+            else:
+                return UNSYMMETRY[symmetry][move], score, depth
+        return None
+
+# Params: path -> book file, or None
+# Returns: the Book, None if there's no file
+def load_book(path):
+    if path is None or not os.path.exists(path):
+        return None
+    return Book(path)
+
+# Write a book file
+# Params: path -> file to write, entries -> (key, score, move, depth) tuples
+def write_book(path, entries):
+    entries = sorted(entries)
+    with open(path, "wb") as f:
+        f.write(BOOK_HEADER.pack(BOOK_MAGIC, len(entries)))
+        for entry in entries:
+            f.write(BOOK_ENTRY.pack(*entry))
+
+#########################################################################
+########################## End of Opening Book ##########################
+#########################################################################
+
 #########################################################################
 ########################### Alpha Beta Search ###########################
 #########################################################################
 
-# Initial Alpha beta step - Finds max values from child nodes
-# Params: board -> state of the 9x9 board
-# Returns: The next move to make
-def alphabeta(board):
-    # Global variables: curr -> current board number
-    global curr
-    # Depth -> level of depth for the child board 
-    depth = 0
-    # Move to return, 0 if no good moves, else, 
-    nextMove = 0
-
-    # Set up alpha (max value, initiate as -infinity)
-    alpha = -float('inf')
-    # Set up beta (min value, initiate as infinity)
-    beta = float('inf')
-
-    # All possible moves that can be made on this board
-    children = possibleMoves(board, curr)
-    depth += 1
-
-    for child in children:
-        board[curr][child] = 1
-        eval = calc_min(board, child, alpha, beta, depth, curr)
-        board[curr][child] = 0
-        if eval > alpha:
-            alpha = eval
-            nextMove = child
-    return nextMove # this returns the next move to make
-
-# Minimizer. 
-# Params: board -> curr board state, move -> new board to play on
-#         alpha -> alpha value, beta -> beta value
-#         depth -> level of child, curr_move -> previous board played
-# Returns: The minimizer move.
-def calc_min(board, move, alpha, beta, depth, curr_move):
-    global depth_limit
-
-    # Checks if we made a winning move last move
-    if checkWin(board, curr_move, 1):
-        return float('inf')
-
-    # If depth of child passes the limit
-    if depth >= depth_limit:
-        return calc_h(board)
-
-    children = possibleMoves(board, move)
-    depth += 1
-
-    for child in children:
-        board[move][child] = 2
-        eval = calc_max(board, child, alpha, beta, depth, move)
-        beta = min(beta, eval)
-        board[move][child] = 0
-        if beta <= alpha:
-            break
-    return beta
+# An Engine is everything a search needs between moves: its transposition
+# table, move ordering tables, opening book, counters and worker pool.
+# It doesn't hold a game, the position to search is passed in, so one
+# engine can search for any number of games (see serve()). An engine
+# searches one position at a time.
+#
+# There are two searches, both negamax:
+#   "pvs"       -> principal variation search, every move after the first is
+#                  scouted with a null window, and each depth starts with an
+#                  aspiration window around the last depth's score
+#   "alphabeta" -> plain alpha beta, every move gets the full window
+# They find the same scores, pvs searches fewer nodes to do it.
+SEARCHES = ("pvs", "alphabeta")
+# --search also takes "mcts", Monte Carlo tree search (mcts.py) in place of Engine
+ENGINES = SEARCHES + ("mcts",)
+
+# Half width of the aspiration window. It is centred on the score from two
+# depths back, whose last ply was played by the same side, as scores swing
+# between odd and even depths. Most depths land within a few points of it,
+# the rest are searched again with the window opened on the side they fell
+# out of. It's in the hand picked weights' points, times the scale of the
+# weights in use.
+ASPIRATION = 4
+
+# No score found yet at the root
+NO_ALPHA = -INF
+
+# Endgame solver settings, see Endgame Solver below.
+# Try to solve the game once this few cells are empty. On self-play
+# positions most solves take milliseconds, but the slowest grow sharply
+# past 48: at 50 empty 3 in 40 took over 2s, at 48 and 49 the slowest of
+# 40 took 1.4s, and at 52 a quarter took over 4s.
+SOLVE_EMPTY = 48
+# Share of the move's time the solver may use before the normal search takes over
+SOLVE_SHARE = 0.5
+# Once the solver runs out of time it isn't tried again until this many
+# fewer cells are empty, rather than taking its share of every move
+SOLVE_RETRY = 8
+# Most solved positions kept, the cache is emptied when it's full
+SOLVED_MAX = 1 << 20
+# Solved positions store a lower and upper bound on the result, each as an
+# index into RESULTS
+RESULTS = (-WIN, 0, WIN)
+RESULT_INDEX = {-WIN: 0, 0: 1, WIN: 2}
+
+class Engine:
+
+    # Params: tt_mb -> transposition table size in megabytes,
+    #         tt_policy -> its replacement policy, book -> Book or None,
+    #         search -> one of SEARCHES,
+    #         weights -> (weights, scale) from load_weights, None for the hand picked ones
+    def __init__(self, tt_mb=TT_MB, tt_policy="both", book=None, search="pvs", weights=None):
+        self.tt = TranspositionTable(tt_mb, tt_policy)
+        self.ordering = MoveOrdering()
+        self.book = book
+        self.search = search
+        self.pvs = search == "pvs"
+        # Heuristic weights and their scale, see Heuristic
+        self.weights, self.scale = weights or (HEURISTIC_WEIGHTS, 1)
+        # Depth Limit, how many levels of child boards to create.
+        # Set by the iterative deepening in alphabeta, 1, 2, 3... until time runs out
+        self.depth_limit = 1
+        # Deepest depth alphabeta searches to, fixed depth runs lower it (bench.py)
+        self.max_depth = MAX_PLY
+        # When the search has to stop, checked whenever nodes & check_mask is 0
+        self.deadline = float('inf')
+        self.check_mask = CHECK_MASK
+        # Nodes searched this move, leaf evaluations, beta cutoffs and
+        # cutoffs by the first move tried
+        self.nodes = 0
+        self.leaves = 0
+        self.cutoffs = 0
+        self.first_cutoffs = 0
+        # What alphabeta found this move, and a record of each depth it finished
+        self.search_info = {}
+        self.iterations = []
+        # Root splitting, see Parallel Search
+        self.pool = None
+        self.shared_alpha = None
+        self.search_id = 0
+        # See Endgame Solver
+        self.solve_empty = SOLVE_EMPTY
+        self.solved = {}
+        # Empty cells when the solver last ran out of time, 0 if it hasn't
+        self.solve_failed = 0
+        # See Pondering
+        self.ponder_thread = None
+        self.ponder_results = {}
+        self.switch_interval = sys.getswitchinterval()
+        self.searched_ahead = False
+
+    # Zero the search counters
+    def reset_counters(self):
+        self.nodes = 0
+        self.leaves = 0
+        self.cutoffs = 0
+        self.first_cutoffs = 0
+        self.iterations = []
+
+    # Returns: what the last search found and its counters, for telemetry_record
+    def stats(self):
+        return dict(self.search_info, nodes=self.nodes, leaves=self.leaves,
+                    cutoffs=self.cutoffs, first_cutoffs=self.first_cutoffs,
+                    iterations=self.iterations)
+
+    # Finds which move to play.
+    # If we are losing in every move, play the first legal one
+    # Else, play what was suggested by Alpha Beta Search
+    # Params: as alphabeta
+    # Returns: the cell to play
+    def choose_move(self, board, boardnum, move_start, budget, pondered=None):
+        move = self.alphabeta(board, boardnum, move_start, budget, pondered)
+        if move == 0:
+            move = possibleMoves(board, boardnum)[0]
+        return move
+
+    # Iterative deepening. Searches to depth 1, 2, 3... until the move's time
+    # is used up, the answer is known or the whole game has been searched.
+    # Forced moves are played without a search, and late in the game the
+    # endgame solver gets the first go.
+    # Each depth reuses the transposition table filled by the ones before it,
+    # and with pvs searches a window around the score of the one before it.
+    # A pondered result for this position carries on from the depth it reached.
+    # Params: board -> state of the 9x9 board, boardnum -> board we play in
+    #         move_start -> when the move was asked for, budget -> seconds from then
+    #         pondered -> (move, score, depth) found while pondering, or None
+    # Returns: The next move to make, from the deepest search that finished
+    def alphabeta(self, board, boardnum, move_start, budget, pondered=None):
+        self.reset_counters()
+        # A winning move, or a single move that doesn't lose, needs no search,
+        # nor the book, whose move could have come from a shallower search
+        bits = board.bits
+        wins = THREATS[bits[1][boardnum]] & ~(bits[1][boardnum] | bits[2][boardnum])
+        if wins:
+            self.search_info = {"source": "forced", "score": WIN, "depth": 1}
+            return EMPTY[511 ^ wins][0]
+        children = possibleMoves(board, boardnum)
+        safe = safeMoves(board, boardnum, 1, children)
+        if len(safe) < 2:
+            self.search_info = {"source": "forced", "score": None if safe else -WIN,
+                                "depth": 0 if safe else 2}
+            return safe[0] if safe else children[0]
+        entry = self.book.lookup(board, boardnum) if self.book else None
+        if entry:
+            self.search_info = {"source": "book", "score": entry[1], "depth": entry[2]}
+            return entry[0]
+        nextMove = 0
+        first_depth = 1
+        # Score of each depth searched
+        scores = []
+        self.search_info = {"source": "search", "score": 0, "depth": 0}
+        if pondered:
+            nextMove, score, depth = pondered
+            self.search_info = {"source": "ponder", "score": score, "depth": depth}
+            if abs(score) >= WIN:
+                return nextMove
+            first_depth = depth + 1
+        self.search_id += 1
+        self.deadline = move_start + budget
+        # Already done for this move if we pondered it
+        if not self.searched_ahead:
+            self.tt.new_search()
+            self.ordering.new_search()
+        self.searched_ahead = False
+        search = self.search_root_parallel if self.pool else self.search_root
+
+        # No point searching past the number of empty cells left
+        empty = sum(len(possibleMoves(board, i)) for i in range(1, 10))
+        # More empty cells than when the solver gave up, it's a new game
+        if empty > self.solve_failed:
+            self.solve_failed = 0
+        solved = self.solved
+        if empty <= self.solve_empty and (not self.solve_failed
+                                          or empty <= self.solve_failed - SOLVE_RETRY):
+            self.deadline = move_start + budget * SOLVE_SHARE
+            try:
+                move, score = self.solve_root(board, boardnum)
+            except SearchTimeout:
+                score = None
+                self.solve_failed = empty
+            self.deadline = move_start + budget
+            if score is not None and score > -WIN:
+                self.search_info = {"source": "solver", "score": score, "depth": empty}
+                self.deadline = float('inf')
+                return move
+            # A proven loss still gets the normal search's move, the one whose
+            # loss is furthest away, which gives them the most chances to go
+            # wrong. The solved positions would only tell it every move loses.
+            if score is not None:
+                self.solved = {}
+        # The share of the time left that deepening may use, counted from
+        # here so a solver that ran out of time doesn't leave us at depth 1
+        search_start = time.time()
+        deepen_until = search_start + (move_start + budget - search_start) * DEEPEN_SHARE
+        for self.depth_limit in range(first_depth, min(empty, self.max_depth) + 1):
+            searched = self.nodes
+            alpha, beta = -INF, INF
+            if self.pvs and len(scores) > 1:
+                window = ASPIRATION * self.scale
+                alpha, beta = scores[-2] - window, scores[-2] + window
+            try:
+                while True:
+                    move, score = search(board, boardnum, alpha, beta)
+                    if score <= alpha and alpha > -INF:
+                        alpha = -INF
+                    elif score >= beta and beta < INF:
+                        # Already better than the last depth's move
+                        nextMove = move
+                        beta = INF
+                    else:
+                        break
+            except SearchTimeout:
+                break
+            # Every move loses at this depth, keep the last depth's move
+            if score <= -WIN and nextMove:
+                break
+            nextMove = move
+            scores.append(score)
+            self.search_info.update(score=score, depth=self.depth_limit)
+            self.iterations.append({"depth": self.depth_limit, "move": move, "score": score,
+                                    "nodes": self.nodes - searched,
+                                    "seconds": round(time.time() - move_start, 4)})
+            if abs(score) >= WIN or time.time() > deepen_until:
+                break
+        self.solved = solved
+        self.deadline = float('inf')
+        return nextMove # this returns the next move to make
+
+    # Initial Alpha beta step - Finds max values from child nodes
+    # Params: board -> state of the 9x9 board, boardnum -> board we play in,
+    #         alpha, beta -> window to search with, the full window by default
+    # Returns: The best move and its score at depth_limit. A score <= alpha
+    #          means every move failed low (the move is 0), >= beta that the
+    #          move failed high and the rest weren't searched
+    def search_root(self, board, boardnum, alpha=-INF, beta=INF):
+        # Depth -> level of depth for the child board
+        depth = 0
+        # Move to return, 0 if no good moves, else,
+        nextMove = 0
+
+        # All possible moves that can be made on this board,
+        # the best one from the last depth first
+        key, symmetry, children = self.root_moves(board, boardnum)
+        depth += 1
+
+        for child in children:
+            board.make(boardnum, child, 1)
+            try:
+                if not self.pvs or child == children[0]:
+                    eval = -self.negamax(board, child, -beta, -alpha, depth, boardnum, 2)
+                else:
+                    # Scout, only search it properly if it beats the best so far
+                    eval = -self.negamax(board, child, -alpha - 1, -alpha, depth, boardnum, 2)
+                    if alpha < eval < beta:
+                        eval = -self.negamax(board, child, -beta, -eval, depth, boardnum, 2)
+            finally:
+                board.unmake(boardnum, child, 1)
+            if eval > alpha:
+                alpha = eval
+                nextMove = child
+                if alpha >= beta:
+                    break
+        if nextMove:
+            self.tt.store(key, self.depth_limit, LOWER if alpha >= beta else EXACT, alpha,
+                          SYMMETRY[symmetry][nextMove])
+        return nextMove, alpha
+
+    # Moves that lead to symmetric versions of the same position are only
+    # searched once, the first in search order standing for all of them,
+    # and moves that let them win next move are left out unless all do.
+    # Params: board -> state of the 9x9 board, boardnum -> board we play in
+    # Returns: root's table key and symmetry (see Board.key) and its moves
+    #          in search order
+    def root_moves(self, board, boardnum):
+        key, symmetry = board.key(1, boardnum)
+        data = self.tt.probe(key)
+        best = 0 if data is None else UNSYMMETRY[symmetry][data & 15]
+        children = possibleMoves(board, boardnum)
+        children = safeMoves(board, boardnum, 1, children) or children
+        children = self.ordering.order(board, boardnum, 1, children, best, 0)
+        seen = set()
+        distinct = []
+        for child in children:
+            board.make(boardnum, child, 1)
+            child_key = board.key(2, child)[0]
+            board.unmake(boardnum, child, 1)
+            if child_key not in seen:
+                seen.add(child_key)
+                distinct.append(child)
+        return key, symmetry, distinct
+
+    # Searches a node for either player. Scores are from the point of view of
+    # the player to move, so a child's score is the negative of what it returns
+    # and calc_h, which scores for us, is negated on their nodes.
+    # With pvs the first child is searched with the full window and the rest
+    # with a null window (alpha, alpha + 1), which only tells whether they beat
+    # alpha. The few that do are searched again with the window above that.
+    # Fail soft, a node that fails returns the best score it saw rather than
+    # the bound, so the table and the aspiration windows get tighter bounds.
+    # Params: board -> curr board state, move -> new board to play on
+    #         alpha -> alpha value, beta -> beta value
+    #         depth -> level of child, curr_move -> previous board played
+    #         player -> player to move, 1 or 2
+    # Returns: The node's score for player, an upper bound if it's <= alpha
+    #          and a lower bound if it's >= beta
+    def negamax(self, board, move, alpha, beta, depth, curr_move, player):
+        other = 3 - player
+        # Checks if the other player won with the last move
+        if checkWin(board, curr_move, other):
+            return -WIN
+
+        # A line of two with the third cell empty wins on this move
+        bits = board.bits
+        if THREATS[bits[player][move]] & ~(bits[1][move] | bits[2][move]):
+            return WIN
+
+        children = possibleMoves(board, move)
+        # Sent to a full board, servt scores this as a draw, at the depth limit too
+        if not children:
+            return 0
+
+        # If depth of child passes the limit
+        if depth >= self.depth_limit:
+            self.leaves += 1
+            return calc_h(board, self.weights) if player == 1 else -calc_h(board, self.weights)
+
+        self.nodes += 1
+        if not self.nodes & self.check_mask and time.time() > self.deadline:
+            raise SearchTimeout()
+
+        # Use what we know about this position from earlier searches
+        tt = self.tt
+        key, symmetry = board.key(player, move)
+        if self.solved:
+            bounds = self.solved.get(key)
+            if bounds is not None:
+                low = RESULTS[bounds >> 2]
+                high = RESULTS[bounds & 3]
+                if low == high or low >= beta:
+                    return low
+                if high <= alpha:
+                    return high
+        remaining = self.depth_limit - depth
+        best = 0
+        data = tt.probe(key)
+        if data is not None:
+            best = UNSYMMETRY[symmetry][data & 15]
+            if data >> 8 & 0xff >= remaining:
+                score = (data >> 24) - SCORE_BIAS
+                bound = data >> 4 & 3
+                if bound == EXACT or (bound == LOWER and score >= beta) \
+                        or (bound == UPPER and score <= alpha):
+                    return score
+        # Moves that let them win next move are -WIN, no need to search them
+        if len(children) > 1:
+            children = safeMoves(board, move, player, children)
+            if not children:
+                return -WIN
+        children = self.ordering.order(board, move, player, children, best, depth)
+        depth += 1
+
+        pvs = self.pvs
+        first = children[0]
+        alpha_in = alpha
+        top = -INF
+        for child in children:
+            board.make(move, child, player)
+            try:
+                if not pvs or child == first:
+                    eval = -self.negamax(board, child, -beta, -alpha, depth, move, other)
+                else:
+                    eval = -self.negamax(board, child, -alpha - 1, -alpha, depth, move, other)
+                    if alpha < eval < beta:
+                        eval = -self.negamax(board, child, -beta, -eval, depth, move, other)
+            finally:
+                board.unmake(move, child, player)
+            if eval > top:
+                top = eval
+                if eval > alpha:
+                    alpha = eval
+                    best = child
+            if alpha >= beta:
+                tt.store(key, remaining, LOWER, top, SYMMETRY[symmetry][best])
+                self.cutoffs += 1
+                self.first_cutoffs += child == first
+                self.ordering.add_cutoff(player, move, child, depth - 1, remaining)
+                return top
+        tt.store(key, remaining, EXACT if alpha > alpha_in else UPPER, top,
+                 SYMMETRY[symmetry][best])
+        return top
+
+    #####################################################################
+    ########################### Endgame Solver ##########################
+    #####################################################################
+
+    # Once few cells are left (solve_empty) the game can often be searched to
+    # the end. solve() is alpha beta over the real results only, WIN, 0 for a
+    # draw or -WIN, with no depth limit and no heuristic. Scores are from the
+    # player to move's point of view, as in negamax. Solved positions go into
+    # self.solved, key -> lower and upper bound, which is kept between moves
+    # and also read by negamax. A solve that runs out of time still leaves
+    # what it proved there for the normal search and the next move.
+
+    # Params: board -> state of the 9x9 board, boardnum -> board we play in
+    # Returns: the best move and its proven score
+    def solve_root(self, board, boardnum):
+        nextMove = 0
+        alpha = -INF
+        for child in self.root_moves(board, boardnum)[2]:
+            board.make(boardnum, child, 1)
+            try:
+                eval = -self.solve(board, child, -WIN, -alpha, 1, boardnum, 2)
+            finally:
+                board.unmake(boardnum, child, 1)
+            if eval > alpha:
+                alpha = eval
+                nextMove = child
+                if alpha >= WIN:
+                    break
+        return nextMove, alpha
+
+    # Proves the result of a node
+    # Params: board -> curr board state, move -> new board to play on
+    #         alpha -> alpha value, beta -> beta value
+    #         ply -> level of the node, curr_move -> previous board played
+    #         player -> player to move, 1 or 2
+    # Returns: WIN, 0 or -WIN for player, an upper bound if it's <= alpha
+    #          and a lower bound if it's >= beta
+    def solve(self, board, move, alpha, beta, ply, curr_move, player):
+        other = 3 - player
+        # Checks if the other player won with the last move
+        if checkWin(board, curr_move, other):
+            return -WIN
+
+        children = possibleMoves(board, move)
+        # Sent to a full board, servt scores this as a draw
+        if not children:
+            return 0
+        # Winning this 3x3 board wins the game
+        bits = board.bits
+        if THREATS[bits[player][move]] & ~(bits[1][move] | bits[2][move]):
+            return WIN
+
+        self.nodes += 1
+        if not self.nodes & self.check_mask and time.time() > self.deadline:
+            raise SearchTimeout()
+
+        solved = self.solved
+        key = board.key(player, move)[0]
+        low = -WIN
+        high = WIN
+        bounds = solved.get(key)
+        if bounds is not None:
+            low = RESULTS[bounds >> 2]
+            high = RESULTS[bounds & 3]
+            if low == high or low >= beta:
+                return low
+            if high <= alpha:
+                return high
+            alpha = max(alpha, low)
+            beta = min(beta, high)
+        if len(children) > 1:
+            children = safeMoves(board, move, player, children)
+            if not children:
+                return -WIN
+        children = self.ordering.order(board, move, player, children, 0, ply)
+
+        alpha_in = alpha
+        top = -WIN
+        for child in children:
+            board.make(move, child, player)
+            try:
+                eval = -self.solve(board, child, -beta, -alpha, ply + 1, move, other)
+            finally:
+                board.unmake(move, child, player)
+            if eval > top:
+                top = eval
+                if eval > alpha:
+                    alpha = eval
+                    if alpha >= beta:
+                        self.ordering.add_cutoff(player, move, child, ply, 1)
+                        break
+        if top <= alpha_in:
+            high = top
+        elif top >= beta:
+            low = top
+        else:
+            low = high = top
+        if len(solved) >= SOLVED_MAX:
+            solved.clear()
+        solved[key] = RESULT_INDEX[low] << 2 | RESULT_INDEX[high]
+        return top
+
+    #####################################################################
+    ########################## Parallel Search ##########################
+    #####################################################################
+
+    # With --workers above 1 the root's children are shared out over a pool of
+    # processes. Each worker has its own Engine, kept between moves like ours.
+    # Children are handed out best first, and a worker starting a child
+    # searches it with alpha set to the best score found so far (shared_alpha)
+    # less one. A child that can't beat the best so far fails low quickly, one
+    # that ties or beats it gets its exact score, so the best score and the
+    # first child in search order to reach it are the same as the serial
+    # search at the same depth would find. The root's aspiration window is
+    # passed on, a worker's alpha is never below it. search_id counts our
+    # searches so workers know when a new move starts.
+
+    # Start the worker processes
+    # Params: n -> number of workers, less than 2 searches in this process
+    def start_pool(self, n):
+        if n < 2:
+            return
+        self.shared_alpha = multiprocessing.Value("q", NO_ALPHA, lock=False)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            n, initializer=worker_init, initargs=(self.tt.mb, self.shared_alpha, None, self.search,
+                                                   (self.weights, self.scale), self.tt.policy))
+        # Have every worker running before the game starts, not on our first move
+        for future in [self.pool.submit(time.sleep, 0.1) for i in range(n)]:
+            future.result()
+
+    # search_root, but with the children searched by the worker pool
+    # Params: board -> state of the 9x9 board, boardnum -> board we play in,
+    #         alpha, beta -> window to search with
+    # Returns: The best move and its score at depth_limit, as search_root
+    def search_root_parallel(self, board, boardnum, alpha=-INF, beta=INF):
+        key, symmetry, children = self.root_moves(board, boardnum)
+        shared_alpha = self.shared_alpha
+        shared_alpha.value = NO_ALPHA
+        futures = {self.pool.submit(search_child, board, boardnum, child, self.depth_limit,
+                                    self.deadline, self.search_id, alpha, beta): child
+                   for child in children}
+        scores = {}
+        timed_out = False
+        for future in concurrent.futures.as_completed(futures):
+            score, counts = future.result()
+            self.nodes += counts[0]
+            self.leaves += counts[1]
+            self.cutoffs += counts[2]
+            self.first_cutoffs += counts[3]
+            if score is None:
+                timed_out = True
+                for other in futures:
+                    other.cancel()
+                continue
+            scores[futures[future]] = score
+            if score > shared_alpha.value:
+                shared_alpha.value = score
+        if timed_out:
+            raise SearchTimeout()
+
+        # Highest score, the first child in search order on a tie
+        nextMove = children[0]
+        for child in children:
+            if scores[child] > scores[nextMove]:
+                nextMove = child
+        score = scores[nextMove]
+        if score <= alpha:
+            return 0, alpha
+        self.tt.store(key, self.depth_limit, LOWER if score >= beta else EXACT, score,
+                      SYMMETRY[symmetry][nextMove])
+        return nextMove, score
 
-# Maximizer.
-# Params: board -> curr board state, move -> new board to play on
-#         alpha -> alpha value, beta -> beta value
-#         depth -> level of child, curr_move -> previous board played
-# Returns: The maximizer move.
-def calc_max(board, move, alpha, beta, depth, curr_move):
-    global depth_limit
+    #####################################################################
+    ############################# Pondering #############################
+    #####################################################################
 
-    # Check if they made a winning move last move
-    if checkWin(board, curr_move, 2):
-        return -float('inf')
+    # With --ponder we keep searching while the opponent thinks. Once our move is
+    # sent, a background thread searches our reply to each move they can make in
+    # the board we sent them to: depth 1 for every move, then depth 2 and so on,
+    # the move our own search expects them to play first. The thread stops as
+    # soon as the server says anything, and if their move was searched the
+    # result is where our search for it starts.
+    #
+    # The thread uses the engine's search state, so nothing else may search
+    # with this engine while it runs. respond() stops it before searching.
+    # It is stopped by setting deadline to 0, which the search checks like any
+    # other deadline, but every PONDER_CHECK_MASK + 1 nodes instead of every
+    # CHECK_MASK + 1, and with the interpreter switching threads every
+    # PONDER_SWITCH seconds, so the thread is gone about a millisecond after
+    # the server speaks rather than up to a couple of dozen.
+    # ponder_results maps their move -> (our move, score, depth) for the
+    # deepest finished search, and searched_ahead is True when the tables
+    # were already moved on to the next move's search.
 
-    # If depth of child passes the limit
-    if depth >= depth_limit:
-        return calc_h(board)
+    # Start pondering once our move is sent
+    # Params: board -> state of the 9x9 board, boardnum -> board they play in
+    def start_ponder(self, board, boardnum):
+        self.ponder_results = {}
+        replies = possibleMoves(board, boardnum)
+        if not replies:
+            return
+        # Their likely move from the search we just did, first
+        key, symmetry = board.key(2, boardnum)
+        data = self.tt.probe(key)
+        expected = 0 if data is None else UNSYMMETRY[symmetry][data & 15]
+        replies = sorted(replies, key=lambda reply: reply != expected)
+        self.tt.new_search()
+        self.ordering.new_search()
+        self.searched_ahead = True
+        self.deadline = float('inf')
+        self.check_mask = PONDER_CHECK_MASK
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(PONDER_SWITCH)
+        self.ponder_thread = threading.Thread(target=self.ponder,
+                                              args=(board.copy(), boardnum, replies),
+                                              daemon=True)
+        self.ponder_thread.start()
 
-    children = possibleMoves(board, move)
-    depth += 1
+    # Thread body, searches all their replies one depth at a time
+    # Params: board -> copy of the board, boardnum -> board they play in,
+    #         replies -> their moves, in the order to search them
+    def ponder(self, board, boardnum, replies):
+        results = self.ponder_results
+        self.nodes = 0
+        try:
+            empty = sum(len(possibleMoves(board, i)) for i in range(1, 10))
+            for self.depth_limit in range(1, empty):
+                for reply in replies:
+                    result = results.get(reply)
+                    if result and abs(result[1]) >= WIN:
+                        continue
+                    board.make(boardnum, reply, 2)
+                    try:
+                        if not checkWin(board, boardnum, 2) and possibleMoves(board, reply):
+                            move, score = self.search_root(board, reply)
+                            results[reply] = (move, score, self.depth_limit)
+                    finally:
+                        board.unmake(boardnum, reply, 2)
+        except SearchTimeout:
+            pass
 
-    for child in children:
-        board[move][child] = 1
-        eval = calc_min(board, child, alpha, beta, depth, move)
-        alpha = max(alpha, eval)
-        board[move][child] = 0
-        if beta <= alpha:
-            break      
-    return alpha
+    # Stop pondering, called as soon as the server sends anything
+    # Params: reply -> their move if they made one, else 0
+    # Returns: the pondered (move, score, depth) for it, None if there isn't one
+    def stop_ponder(self, reply=0):
+        if self.ponder_thread is None:
+            return None
+        self.deadline = 0
+        self.ponder_thread.join()
+        self.ponder_thread = None
+        self.deadline = float('inf')
+        self.check_mask = CHECK_MASK
+        sys.setswitchinterval(self.switch_interval)
+        return self.ponder_results.get(reply)
+
+# Params: as Engine, search -> one of ENGINES
+# Returns: an Engine, or an mcts.MctsEngine for "mcts", which only needs
+#          numpy when it's asked for and has no heuristic to weight
+def make_engine(tt_mb=TT_MB, tt_policy="both", book=None, search="pvs", weights=None):
+    if search == "mcts":
+        import mcts
+        return mcts.MctsEngine(book)
+    return Engine(tt_mb, tt_policy, book, search, weights)
 
 #########################################################################
 ########################### End of Alpha Beta ###########################
 #########################################################################
 
+#########################################################################
+########################### Worker Processes ############################
+#########################################################################
+
+# Pools of processes each have an Engine of their own, made when the
+# process starts. Root splitting (Engine.start_pool) sends them one child
+# of the root at a time with search_child, serve() sends them whole moves
+# with search_move.
+
+worker_engine = None
+
+# Runs in each worker when it starts
+# Params: mb -> transposition table size, alpha -> shared best root score
+#         for search_child, book -> opening book file for search_move,
+#         search -> one of ENGINES, weights -> as Engine,
+#         tt_policy -> transposition table replacement policy
+def worker_init(mb, alpha=None, book=None, search="pvs", weights=None, tt_policy="both"):
+    global worker_engine
+    worker_engine = make_engine(mb, tt_policy, load_book(book), search, weights)
+    worker_engine.shared_alpha = alpha
+
+# Runs in a worker, searches one child of the root
+# Params: board -> root board state, boardnum -> board the root plays in,
+#         child -> cell to search, limit -> depth_limit, stop_at -> deadline,
+#         search -> search_id of the move being searched,
+#         alpha, beta -> the root's window
+# Returns: the child's score (None if out of time) and the search counters
+def search_child(board, boardnum, child, limit, stop_at, search, alpha, beta):
+    engine = worker_engine
+    if search != engine.search_id:
+        engine.search_id = search
+        engine.tt.new_search()
+        engine.ordering.new_search()
+    engine.depth_limit = limit
+    engine.deadline = stop_at
+    engine.reset_counters()
+    best = engine.shared_alpha.value
+    if best != NO_ALPHA:
+        alpha = max(alpha, best - 1)
+    board.make(boardnum, child, 1)
+    try:
+        score = -engine.negamax(board, child, -beta, -alpha, 1, boardnum, 2)
+    except SearchTimeout:
+        score = None
+    return score, (engine.nodes, engine.leaves, engine.cutoffs, engine.first_cutoffs)
+
+# Runs in a worker, chooses the move for one of serve()'s games
+# Params: as Engine.alphabeta
+# Returns: the move and Engine.stats() of its search
+def search_move(board, boardnum, move_start, budget):
+    move = worker_engine.choose_move(board, boardnum, move_start, budget)
+    return move, worker_engine.stats()
+
+#########################################################################
+######################## End of Worker Processes ########################
+#########################################################################
+
 # All the possible moves that can be made on the current 3x3 board
 # Params: board -> current 9x9 board state, boardnum -> which 3x3 board to play
-# Returns: Dictionary with all the possible moves that can be made
+# Returns: Tuple with all the possible moves that can be made
 def possibleMoves(board,boardnum):
-    moves = {}
-    for i in range(1,10):
-        if board[boardnum][i] == 0:
-            moves[i] = i
-    return moves
-    
-# Finds which move to play.
-# If we are losing in every move, make a random move
-# Else, play what was suggested by Alpha Beta Search    
-def play():
-    global boards
-    print_board(boards)
-    moveToMake = alphabeta(boards)
-    if moveToMake == 0:
-        for i in range(1,10):
-            if boards[curr][i] == 0:
-                place(curr, i, 1)
-                return i
-    else:
-        place(curr, moveToMake, 1)
-        return moveToMake
-    
+    return board.moves(boardnum)
+
+# Moves that don't lose straight away, by sending the other player to a
+# 3x3 board where they already have a line with only the third cell empty.
+# A move that wins the board is always kept, the game ends before they move.
+# Params: board -> current 9x9 board state, boardnum -> which 3x3 board to play,
+#         player -> player to move, children -> moves to check
+# Returns: List of the safe moves, in the same order
+def safeMoves(board, boardnum, player, children):
+    bits = board.bits
+    mine = bits[1]
+    theirs = bits[2]
+    threats = bits[3 - player]
+    wins = THREATS[bits[player][boardnum]]
+    safe = []
+    for c in children:
+        empty = 511 ^ (mine[c] | theirs[c])
+        if c == boardnum:
+            # The move itself fills a cell of the board it sends them to
+            empty ^= CELL[c]
+        if CELL[c] & wins or not THREATS[threats[c]] & empty:
+            safe.append(c)
+    return safe
+
 #######################################################################
 ############################## Heuristic ##############################
 #######################################################################
 
+# The heuristic is a weighted sum of HEURISTIC_FEATURES. The weights were
+# picked by hand as (us*us_boards+2) - them*them_boards, tune.py fits them to
+# the results of recorded games and writes them to a weights file, which
+# --weights loads. Weights are ints, so scores still pack into the table,
+# and a file's weights are scale times the size of the hand picked ones,
+# so it can keep fractions of them.
+HEURISTIC_FEATURES = ("us*us_boards", "them*them_boards", "us", "them", "us_boards",
+                      "them_boards", "1")
+HEURISTIC_WEIGHTS = (1, -1, 0, 0, 0, 0, 2)
+# The most each feature can be, from the most ways to win one board
+_most_ways = max(entry & 0xff for entry in H_TABLE)
+HEURISTIC_LIMITS = (9 * _most_ways * 9, 9 * _most_ways * 9, 9 * _most_ways, 9 * _most_ways,
+                    9, 9, 1)
+# Largest |calc_h| a file's weights may give, far enough below WIN that no
+# heuristic score is ever taken for a proven win or loss
+HEURISTIC_MAX = WIN // 10
+# Default weights file, next to this file
+WEIGHTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent.weights")
+
 # Returns the heuristic for alpha beta search.
-# Params: board -> 9x9 board state
-# Returns: Heuristic value (Our # wins * Our # board win - their # wins * their # board win)
-def calc_h(board):
+# A "way to win" is a line holding two of a player's cells and an empty one.
+# The totals are kept by Board.make/unmake from H_TABLE, so this just unpacks them.
+# Params: board -> 9x9 board state, weights -> one for each of HEURISTIC_FEATURES
+# Returns: Heuristic value, with the hand picked weights
+#          (Our # wins * Our # board win - their # wins * their # board win)
+def calc_h(board, weights=HEURISTIC_WEIGHTS):
+    h = board.h
     # us -> number of ways we can win
-    # us_array -> number of boards we can win in
-    us = 0 
-    us_array = []
+    # us_boards -> number of boards we can win in
+    us = h & 0xff
+    us_boards = h >> 8 & 0xff
     # them -> number of ways they can win
-    # them_array -> number of boards they can win in
-    them = 0
-    them_array = []
-
-    for i in range(1,10):
-        # Us / The rows
-        if board[i][1] == board[i][2] == 1 and board[i][3] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][1] == board[i][3] == 1 and board[i][2] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][2] == board[i][3] == 1 and board[i][1] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][4] == board[i][5] == 1 and board[i][6] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][4] == board[i][6] == 1 and board[i][5] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][5] == board[i][6] == 1 and board[i][4] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][7] == board[i][8] == 1 and board[i][9] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][7] == board[i][9] == 1 and board[i][8] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][8] == board[i][9] == 1 and board[i][7] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-
-        # Us / The columns
-        if board[i][1] == board[i][4] == 1 and board[i][7] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][1] == board[i][7] == 1 and board[i][4] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][4] == board[i][7] == 1 and board[i][1] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][2] == board[i][5] == 1 and board[i][8] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][2] == board[i][8] == 1 and board[i][5] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][5] == board[i][8] == 1 and board[i][2] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][3] == board[i][6] == 1 and board[i][9] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][3] == board[i][9] == 1 and board[i][6] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][6] == board[i][9] == 1 and board[i][3] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-
-        # Us / The diagonals
-        if board[i][1] == board[i][5] == 1 and board[i][9] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][1] == board[i][9] == 1 and board[i][5] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][5] == board[i][9] == 1 and board[i][1] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][3] == board[i][5] == 1 and board[i][7] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][3] == board[i][7] == 1 and board[i][5] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-        if board[i][5] == board[i][7] == 1 and board[i][3] == 0:
-            us += 1
-            if i not in us_array:
-                us_array.append(i)
-
-        # Them / The rows
-        if board[i][1] == board[i][2] == 2 and board[i][3] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][1] == board[i][3] == 2 and board[i][2] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][2] == board[i][3] == 2 and board[i][1] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][4] == board[i][5] == 2 and board[i][6] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][4] == board[i][6] == 2 and board[i][5] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][5] == board[i][6] == 2 and board[i][4] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][7] == board[i][8] == 2 and board[i][9] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][7] == board[i][9] == 2 and board[i][8] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][8] == board[i][9] == 2 and board[i][7] == 0:
-            them += 1
-
-        # Them / The columns
-        if board[i][1] == board[i][4] == 2 and board[i][7] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][1] == board[i][7] == 2 and board[i][4] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][4] == board[i][7] == 2 and board[i][1] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][2] == board[i][5] == 2 and board[i][8] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][2] == board[i][8] == 2 and board[i][5] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][5] == board[i][8] == 2 and board[i][2] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][3] == board[i][6] == 2 and board[i][9] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][3] == board[i][9] == 2 and board[i][6] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][6] == board[i][9] == 2 and board[i][3] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-
-        # Them / The diagonals
-        if board[i][1] == board[i][5] == 2 and board[i][9] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][1] == board[i][9] == 2 and board[i][5] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][5] == board[i][9] == 2 and board[i][1] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][3] == board[i][5] == 2 and board[i][7] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][3] == board[i][7] == 2 and board[i][5] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-        if board[i][5] == board[i][7] == 2 and board[i][3] == 0:
-            them += 1
-            if i not in them_array:
-                them_array.append(i)
-
-    return (us*len(us_array)+2) - them*len(them_array)
+    # them_boards -> number of boards they can win in
+    them = h >> 16 & 0xff
+    them_boards = h >> 24
+
+    w_us, w_them, w_ways, w_their_ways, w_boards, w_their_boards, w_bias = weights
+    return (w_us*us*us_boards + w_them*them*them_boards + w_ways*us + w_their_ways*them
+            + w_boards*us_boards + w_their_boards*them_boards + w_bias)
+
+# Raises ValueError if calc_h could reach HEURISTIC_MAX with the weights
+# Params: weights -> one for each of HEURISTIC_FEATURES, path -> their file, for the message
+def check_weights(weights, path):
+    bound = sum(abs(w) * limit for w, limit in zip(weights, HEURISTIC_LIMITS))
+    if bound >= HEURISTIC_MAX:
+        raise ValueError("%s: the weights could score %d, scores must stay below %d"
+                         % (path, bound, HEURISTIC_MAX))
+
+# Params: path -> weights file written by tune.py, or None
+# Returns: (weights, scale), None if there's no file
+def load_weights(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        saved = json.load(f)
+    if tuple(saved.get("features", ())) != HEURISTIC_FEATURES:
+        raise ValueError(path + " has weights for other features")
+    weights = tuple(int(w) for w in saved["weights"])
+    check_weights(weights, path)
+    return weights, int(saved["scale"])
+
+# Write a weights file
+# Params: path -> file to write, weights -> ints, one for each of HEURISTIC_FEATURES,
+#         scale -> how many times the hand picked weights' size they are,
+#         info -> anything else to save with them, about the fit
+def write_weights(path, weights, scale, info):
+    check_weights(weights, path)
+    with open(path, "w") as f:
+        json.dump(dict(info, features=HEURISTIC_FEATURES, weights=list(weights), scale=scale),
+                  f, indent=2)
+        f.write("\n")
 
 ########################################################################
 ########################### End of Heuristic ###########################
@@ -434,78 +1626,291 @@ def calc_h(board):
 # Params: board -> board state, boardnum -> 3x3 board position, player -> which player
 # Returns: bool if win or not
 def checkWin(board,boardnum,player):
-    
-    if (board[boardnum][1]==board[boardnum][2]==board[boardnum][3]==player or
-    board[boardnum][4]==board[boardnum][5]==board[boardnum][6]==player or
-    board[boardnum][7]==board[boardnum][8]==board[boardnum][9]==player or
-    board[boardnum][1]==board[boardnum][4]==board[boardnum][7]==player or
-    board[boardnum][2]==board[boardnum][5]==board[boardnum][8]==player or
-    board[boardnum][3]==board[boardnum][6]==board[boardnum][9]==player or
-    board[boardnum][1]==board[boardnum][5]==board[boardnum][9]==player or
-    board[boardnum][3]==board[boardnum][5]==board[boardnum][7]==player):
-        return True
-    return False
-    
-# Place a move in one of the 3x3 boards
-def place(board, num, player):
-    global num_moves_made
-    global depth_limit
-    global curr
-    curr = num
-    boards[board][num] = player
-    num_moves_made += 1
-
-    if num_moves_made > 21:
-        depth_limit += 2
-        num_moves_made = 0
-
-# Read what the server sent us and
-# Only parses the strings that are necessary
-def parse(string):
-    if "(" in string:
-        command, args = string.split("(")
-        args = args.split(")")[0]
-        args = args.split(",")
-    else:
-        command, args = string, []
-
-    if command == "second_move":
-        place(int(args[0]), int(args[1]), 2)
-        return play()
-    elif command == "third_move":
-        # place the move that was generated for us
-        place(int(args[0]), int(args[1]), 1)
-        # place their last move
-        place(curr, int(args[2]), 2)
-        return play()
-    elif command == "next_move":
-        place(curr, int(args[0]), 2)
-        return play()
-    elif command == "win":
-        print("Yay!! We win!! :)")
-        return -1
-    elif command == "loss":
-        print("We lost :(")
-        return -1
-    return 0
+    return WINNING[board.bits[player][boardnum]]
+
+#########################################################################
+############################## Game State ###############################
+#########################################################################
+
+# One game as we see it: the board, the board we play in next, our clock
+# and where the game is reported. Searching is left to an Engine.
+
+class GameState:
+
+    # Params: seconds_initially, seconds_per_move -> the server's clock settings,
+    #         telemetry -> open file for telemetry records, or None,
+    #         show_board -> print the board before every move,
+    #         port -> port of the game's server, for telemetry,
+    #         recorder -> Recorder to write the game's moves to, or None
+    def __init__(self, seconds_initially=30, seconds_per_move=2, telemetry=None,
+                 show_board=True, port=None, recorder=None):
+        self.clock = Clock(seconds_initially, seconds_per_move)
+        self.telemetry = telemetry
+        self.recorder = recorder
+        self.show_board = show_board
+        self.port = port
+        self.new_game()
+
+    # Reset the board and our clock at the start of a game
+    def new_game(self):
+        self.board = Board()
+        # Current board to play in
+        self.curr = 0
+        # Moves we have made this game
+        self.moves_made = 0
+        # Game Records id of the game, and its records so far
+        self.game_id = int.from_bytes(os.urandom(8), "little")
+        self.recorded = []
+        self.clock.new_game()
+
+    # Place a move in one of the 3x3 boards
+    # Params: board -> 3x3 board, num -> cell in it, player -> who played it,
+    #         stats -> Engine.stats() of the search that chose it, for the record
+    def place(self, board, num, player, stats=None):
+        if self.recorder:
+            self.recorded.append(self.recorder.write(self, board, num, player, stats))
+        self.curr = num
+        self.board.make(board, num, player)
+
+    # Write the result of the game into its records
+    # Params: result -> RECORD_WIN, RECORD_DRAW or RECORD_LOSS
+    def finish(self, result):
+        if self.recorder:
+            self.recorder.finish(self.recorded, result)
+            self.recorded = []
+
+    # Make our move, once an engine has chosen it
+    # Params: move -> cell to play in board curr,
+    #         stats -> Engine.stats() of the search, needed for telemetry and records
+    def play(self, move, stats=None):
+        self.moves_made += 1
+        if self.telemetry:
+            self.telemetry.write(json.dumps(telemetry_record(stats, self, move)) + "\n")
+            self.telemetry.flush()
+        self.place(self.curr, move, 1, stats)
+
+    # Read one line the server sent us, the messages are the ones in client.c
+    # Our clock starts as soon as we're asked for a move.
+    # Returns: 1 if we have to move now, 0 if there's nothing to send, -1 at the end
+    def parse(self, string):
+        string = string.strip().rstrip(".")
+        if "(" in string:
+            command, args = string.split("(")
+            args = args.split(")")[0]
+            args = args.split(",")
+        else:
+            command, args = string, []
+
+        if not command:
+            return 0
+        if command == "start":
+            # start(x) or start(o), a game is about to begin
+            self.new_game()
+        elif command == "second_move":
+            self.clock.start_move()
+            self.place(int(args[0]), int(args[1]), 2)
+            return 1
+        elif command == "third_move":
+            self.clock.start_move()
+            # place the move that was generated for us
+            self.place(int(args[0]), int(args[1]), 1)
+            # place their last move
+            self.place(self.curr, int(args[2]), 2)
+            return 1
+        elif command == "next_move":
+            self.clock.start_move()
+            self.place(self.curr, int(args[0]), 2)
+            return 1
+        elif command == "last_move":
+            # their move that ended the game
+            self.place(self.curr, int(args[0]), 2)
+        elif command == "win":
+            self.finish(RECORD_WIN)
+            print("Yay!! We win!! :)")
+        elif command == "loss":
+            self.finish(RECORD_LOSS)
+            print("We lost :(")
+        elif command == "draw":
+            self.finish(RECORD_DRAW)
+            print("Draw")
+        elif command == "end":
+            return -1
+        # init needs nothing from us
+        return 0
+
+#########################################################################
+########################### End of Game State ###########################
+#########################################################################
+
+# Answer one line from the server, searching in this process
+# Params: game -> GameState, engine -> Engine searching for it, line -> server message
+# Returns: the move to send back, 0 if there's nothing to send, -1 at the end
+def respond(game, engine, line):
+    response = game.parse(line)
+    # Nothing else may use the engine until pondering stops
+    pondered = engine.stop_ponder(game.curr if response == 1 else 0)
+    if response != 1:
+        return response
+    if game.show_board:
+        print_board(game.board)
+    clock = game.clock
+    move = engine.choose_move(game.board, game.curr, clock.move_start, clock.move_budget(),
+                              pondered)
+    game.play(move, engine.stats() if game.telemetry or game.recorder else None)
+    return move
+
+# Reads the server's messages a whole line at a time. A message can arrive
+# split over two reads, or several in one, so partial lines wait in the
+# buffer until the rest arrives.
+# Params: sock -> connected socket
+# Returns: generator of lines, ends when the server closes the connection
+def read_lines(sock):
+    buffer = b""
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode()
+
+# Play the games of one server, searching in this process (or its root
+# splitting pool) and pondering if asked to
+# Params: port -> server's port, game -> GameState, engine -> Engine,
+#         ponder_enabled -> ponder while they think
+def play_port(port, game, engine, ponder_enabled):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Send our moves straight away rather than waiting to fill a packet
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.connect(('localhost', port))
+    # Stops at end, or if the server goes away without sending it
+    for line in read_lines(s):
+        response = respond(game, engine, line)
+        if response == -1:
+            break
+        elif response > 0:
+            s.sendall((str(response) + "\n").encode())
+            game.clock.end_move()
+            if ponder_enabled:
+                engine.start_ponder(game.board, game.curr)
+    engine.stop_ponder()
+    s.close()
+
+# Play the games of many servers at once from this process. Each connection
+# is read by an asyncio task and its searches are run by a pool of worker
+# processes, one Engine each. A connection keeps to the worker it was given,
+# the one with the fewest connections then, so its transposition table and
+# killers are still there on its next move. Engines are shared between the
+# games on a worker, so memory is per worker, not per game.
+# Params: ports -> servers' ports, games -> a GameState for each,
+#         workers -> number of worker processes, mb -> table size per worker,
+#         book -> opening book file, search -> one of ENGINES,
+#         weights -> heuristic weights from load_weights, or None,
+#         tt_policy -> transposition table replacement policy
+async def serve(ports, games, workers, mb, book, search, weights, tt_policy):
+    # One single process executor per worker, which is what keeps a
+    # connection's searches on the same engine
+    executors = [concurrent.futures.ProcessPoolExecutor(1, initializer=worker_init,
+                                                        initargs=(mb, None, book, search, weights,
+                                                                  tt_policy))
+                 for i in range(workers)]
+    for future in [executor.submit(time.sleep, 0.1) for executor in executors]:
+        future.result()
+    connections = [0] * workers
+    loop = asyncio.get_running_loop()
+
+    async def play(port, game):
+        worker = connections.index(min(connections))
+        connections[worker] += 1
+        reader, writer = await asyncio.open_connection("localhost", port)
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            # StreamReader keeps partial lines like read_lines does
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = game.parse(line.decode())
+                if response == -1:
+                    break
+                elif response == 1:
+                    if game.show_board:
+                        print_board(game.board)
+                    clock = game.clock
+                    move, stats = await loop.run_in_executor(
+                        executors[worker], search_move, game.board, game.curr,
+                        clock.move_start, clock.move_budget())
+                    game.play(move, stats)
+                    writer.write(b"%d\n" % move)
+                    await writer.drain()
+                    clock.end_move()
+        finally:
+            writer.close()
+            connections[worker] -= 1
+
+    try:
+        await asyncio.gather(*(play(port, game) for port, game in zip(ports, games)))
+    finally:
+        for executor in executors:
+            executor.shutdown()
 
 # Connect to socket
 def main():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    port = int(sys.argv[2]) # Usage: ./agent.py -p (port)
+    parser = argparse.ArgumentParser(description="Nine-Board Tic-Tac-Toe agent")
+    parser.add_argument("-p", dest="ports", type=int, nargs="+", default=[31415],
+                        help="port servt is listening on, give several to play them all at once")
+    parser.add_argument("-t", dest="time", type=float, nargs=2, default=(30, 2),
+                        metavar=("initial", "permove"),
+                        help="seconds allowed initially and per move, same as servt's -t")
+    parser.add_argument("--hash", type=int, default=TT_MB,
+                        help="transposition table size in MB, per process (default %(default)s)")
+    parser.add_argument("--tt-policy", choices=TT_POLICIES, default=TT_POLICIES[0],
+                        help="which transposition table entry a new result replaces: both "
+                             "keeps one deepest and one newest, depth the deepest, always "
+                             "the newest (default %(default)s)")
+    parser.add_argument("--workers", type=int,
+                        help="processes searching in parallel "
+                             "(default 1, or one per core with several ports)")
+    parser.add_argument("--search", choices=ENGINES, default=ENGINES[0],
+                        help="search algorithm, mcts needs numpy (default %(default)s)")
+    parser.add_argument("--ponder", action="store_true",
+                        help="keep searching while the opponent thinks, one port only")
+    parser.add_argument("--book", default=BOOK_FILE,
+                        help="opening book written by book.py (default %(default)s)")
+    parser.add_argument("--weights", default=WEIGHTS_FILE,
+                        help="heuristic weights written by tune.py (default %(default)s, "
+                             "the hand picked weights if it doesn't exist)")
+    parser.add_argument("--telemetry", metavar="FILE",
+                        help="append a JSON line about each move's search to FILE, - for stdout")
+    parser.add_argument("--record", default=RECORD_DIR, metavar="DIR",
+                        help="directory to write the record of every game to, "
+                             "read with record.py (default %(default)s)")
+    parser.add_argument("--no-record", action="store_true",
+                        help="don't keep records of the games")
+    parser.add_argument("--quiet", action="store_true",
+                        help="don't print the board before every move")
+    args = parser.parse_args()
+    if args.ponder and len(args.ports) > 1:
+        parser.error("--ponder needs a core per game, it only works with one port")
+    telemetry = None
+    if args.telemetry:
+        telemetry = sys.stdout if args.telemetry == "-" else open(args.telemetry, "a")
+    recorder = None if args.no_record else Recorder(args.record)
+    games = [GameState(*args.time, telemetry=telemetry, show_board=not args.quiet, port=port,
+                       recorder=recorder)
+             for port in args.ports]
 
-    s.connect(('localhost', port))
-    while True:
-        text = s.recv(1024).decode()
-        if not text:
-            continue
-        for line in text.split("\n"):
-            response = parse(line)
-            if response == -1:
-                s.close()
-                return
-            elif response > 0:
-                s.sendall((str(response) + "\n").encode())
+    weights = load_weights(args.weights)
+
+    if len(args.ports) > 1:
+        workers = args.workers or os.cpu_count()
+        asyncio.run(serve(args.ports, games, workers, args.hash, args.book, args.search, weights,
+                          args.tt_policy))
+        return
+    engine = make_engine(args.hash, args.tt_policy, load_book(args.book), args.search, weights)
+    engine.start_pool(args.workers or 1)
+    play_port(args.ports[0], games[0], engine, args.ponder)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
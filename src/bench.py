@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+# Benchmarks for agent.py.
+# Times the kernels the search spends its time in, in calls per second, and
+# the search itself, in nodes per second and seconds to reach each depth,
+# over a fixed corpus of opening, midgame and endgame positions. The endgame
+# positions also time the endgame solver.
+#
+# Results can be saved as JSON and a later run compared against them: any
+# number that got worse by more than --threshold is reported as a regression
+# and the exit status is 1. Kernels are compared by their speed relative
+# to a fixed piece of plain Python timed next to them, against the looser
+# --kernel-threshold. Kernel timings include the call from the benchmark
+# loop, so compare them between runs rather than with each other.
+# --profile runs the search once more under cProfile and lists the functions
+# it spent the most time in.
+#
+# Usage: ./bench.py --json base.json              (save a baseline)
+#        ./bench.py --baseline base.json           (compare with it)
+#        ./bench.py --parts search --depth 9 --profile
+#        ./bench.py --parts search --depth 10 --hash 1 --tt-policy depth
+
+import argparse
+import cProfile
+import functools
+import json
+import platform
+import pstats
+import statistics
+import sys
+import time
+
+import agent
+
+try:
+    import mcts
+except ImportError:
+    mcts = None
+
+# Each position is the moves of a game so far: the board the first move was
+# in, then the cell of every move. The last move is the opponent's, so
+# player 1 moves next, as in the agent. The openings are from random games,
+# the rest from self-play, and none of them has a forced move. The endgames
+# are early enough that the solver takes a while to prove them.
+CORPUS = {
+    "opening": ["328644", "5525693", "37735", "65812"],
+    "midgame": ["8232173144559628633", "1177339224455631886959",
+                "81297852133544969367518", "51344112236598877937"],
+    "endgame": ["157975312243966711948855873261", "48523345112674249769835891827",
+                "7193829514263758436574811628", "895717612238437535947264915655"],
+}
+
+# Playouts per call of the mcts playout kernel, and their random numbers
+PLAYOUT_BATCH = 256
+playout_rng = mcts.np.random.default_rng(18) if mcts else None
+
+# Params: moves -> a CORPUS string
+# Returns: (board, boardnum) with player 1 to play in boardnum
+def position(moves):
+    board = agent.Board()
+    boardnum = int(moves[0])
+    player = 1 if len(moves) % 2 else 2
+    for cell in map(int, moves[1:]):
+        board.make(boardnum, cell, player)
+        boardnum = cell
+        player = 3 - player
+    return board, boardnum
+
+# Returns: list of (phase, name, board, boardnum) for the whole corpus
+def corpus():
+    return [(phase, "%s%d" % (phase, n + 1)) + position(moves)
+            for phase, games in CORPUS.items() for n, moves in enumerate(games)]
+
+#########################################################################
+############################### Kernels #################################
+#########################################################################
+
+# Params: board, boardnum, cell -> a legal move
+def make_unmake(board, boardnum, cell):
+    board.make(boardnum, cell, 1)
+    board.unmake(boardnum, cell, 1)
+
+# Returns: dict of kernel name -> (calls to time, ops per call), one call
+#          per corpus position
+def kernels(positions):
+    engine = agent.Engine(16)
+    calls = {name: [] for name in ("calc_h", "checkWin", "possibleMoves", "safeMoves",
+                                   "make_unmake", "key", "order", "tt_probe", "tt_store")}
+    for phase, name, board, boardnum in positions:
+        moves = agent.possibleMoves(board, boardnum)
+        key = board.key(1, boardnum)[0]
+        engine.tt.store(key, 1, agent.EXACT, 0, moves[0])
+        calls["calc_h"].append(functools.partial(agent.calc_h, board))
+        calls["checkWin"].append(functools.partial(agent.checkWin, board, boardnum, 1))
+        calls["possibleMoves"].append(functools.partial(agent.possibleMoves, board, boardnum))
+        calls["safeMoves"].append(functools.partial(agent.safeMoves, board, boardnum, 1, moves))
+        calls["make_unmake"].append(functools.partial(make_unmake, board, boardnum, moves[0]))
+        calls["key"].append(functools.partial(board.key, 1, boardnum))
+        calls["order"].append(functools.partial(engine.ordering.order, board, boardnum, 1,
+                                                moves, 0, 1))
+        calls["tt_probe"].append(functools.partial(engine.tt.probe, key))
+        calls["tt_store"].append(functools.partial(engine.tt.store, key, 1, agent.EXACT, 0,
+                                                   moves[0]))
+    kernels = {name: (kernel, 1) for name, kernel in calls.items()}
+    if mcts is not None:
+        kernels["playouts"] = ([functools.partial(playout_batch, board, boardnum)
+                                for phase, name, board, boardnum in positions], PLAYOUT_BATCH)
+    return kernels
+
+# Plays a batch of mcts playouts from a position
+def playout_batch(board, boardnum):
+    bits = mcts.np.zeros((PLAYOUT_BATCH, 3, 10), dtype=mcts.np.uint16)
+    bits[:, 1] = board.bits[1]
+    bits[:, 2] = board.bits[2]
+    mcts.playouts(bits, mcts.np.full(PLAYOUT_BATCH, boardnum), mcts.np.ones(PLAYOUT_BATCH, int),
+                  playout_rng)
+
+# Params: calls -> functions to time, per_call -> ops each call counts for,
+#         seconds -> how long to keep calling them
+# Returns: ops per second
+def time_calls(calls, per_call, seconds):
+    ops = 0
+    start = time.perf_counter()
+    while True:
+        for call in calls:
+            call()
+        ops += len(calls) * per_call
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            break
+    return ops / elapsed
+
+# Plain Python work that doesn't depend on agent.py, timed alongside the
+# kernels to measure how fast the machine is running at the time
+def reference():
+    total = 0
+    table = {}
+    for i in range(100):
+        table[i & 15] = total
+        total += i * i >> 3
+    return total
+
+# Times every kernel over a number of rounds. Each round times all of them
+# in turn, each one next to reference(), and its speed relative to
+# reference() in that round counts. The machine's speed drifts by tens of
+# percent between runs on a shared box, which the relative speed mostly
+# cancels, and the median round leaves out the rest of the noise.
+# Params: kernels -> kernels(), seconds -> how long to time each kernel
+#         in a round, rounds -> rounds to time
+# Returns: (ops, relative), dicts of kernel name -> median ops per second,
+#          and median ops per reference() call
+def time_kernels(kernels, seconds, rounds):
+    ops = {name: [] for name in kernels}
+    relative = {name: [] for name in kernels}
+    for n in range(rounds):
+        for name, (calls, per_call) in kernels.items():
+            speed = time_calls(calls, per_call, seconds / 2)
+            ops[name].append(speed)
+            relative[name].append(speed / time_calls([reference], 1, seconds / 2))
+    return ({name: round(statistics.median(found)) for name, found in ops.items()},
+            {name: round(statistics.median(found), 4) for name, found in relative.items()})
+
+#########################################################################
+############################ End of Kernels #############################
+#########################################################################
+
+# Searches every position to a fixed depth with a new Engine each, with the
+# endgame solver off so every position times the same search
+# Params: positions -> corpus(), depth -> depth to search to,
+#         mb -> transposition table size, repeat -> times to search each,
+#         policy -> transposition table replacement policy
+# Returns: dict of totals and the fastest result for each position
+def search(positions, depth, mb, repeat=1, policy="both"):
+    return summarise(fastest([search_once(positions, depth, mb, policy)
+                              for run in range(repeat)]))
+
+# Params: as search
+# Returns: list of a result for each position
+def search_once(positions, depth, mb, policy="both"):
+    results = []
+    for phase, name, board, boardnum in positions:
+        engine = agent.Engine(mb, policy)
+        engine.max_depth = depth
+        engine.solve_empty = -1
+        start = time.time()
+        move = engine.alphabeta(board, boardnum, start, float('inf'))
+        seconds = time.time() - start
+        results.append({"position": name, "phase": phase, "move": move,
+                        "score": engine.search_info["score"],
+                        "depth": engine.search_info["depth"], "nodes": engine.nodes,
+                        "seconds": round(seconds, 4),
+                        "nodes_per_second": round(engine.nodes / seconds),
+                        "seconds_to_depth": [iteration["seconds"]
+                                             for iteration in engine.iterations]})
+    return results
+
+# Solves every endgame position with a new Engine each
+# Params: positions -> corpus(), mb -> transposition table size,
+#         repeat -> times to solve each, policy -> as search
+# Returns: dict of totals and the fastest result for each position
+def solver(positions, mb, repeat=1, policy="both"):
+    return summarise(fastest([solver_once(positions, mb, policy) for run in range(repeat)]))
+
+# Params: as solver
+# Returns: list of a result for each endgame position
+def solver_once(positions, mb, policy="both"):
+    results = []
+    for phase, name, board, boardnum in positions:
+        if phase != "endgame":
+            continue
+        engine = agent.Engine(mb, policy)
+        start = time.time()
+        move, score = engine.solve_root(board, boardnum)
+        seconds = time.time() - start
+        results.append({"position": name, "phase": phase, "move": move, "score": score,
+                        "nodes": engine.nodes, "seconds": round(seconds, 4),
+                        "nodes_per_second": round(engine.nodes / seconds)})
+    return results
+
+# Params: runs -> lists of results for the same positions, from repeated runs
+# Returns: list of the fastest result for each position
+def fastest(runs):
+    return [min(results, key=lambda result: result["seconds"]) for results in zip(*runs)]
+
+# Params: results -> list of position results
+# Returns: dict with the totals, overall and for each phase, and the results
+def summarise(results):
+    summary = {"positions": results}
+    groups = [("all", results)] + [(phase, [result for result in results
+                                            if result["phase"] == phase]) for phase in CORPUS]
+    for group, members in groups:
+        if not members:
+            continue
+        nodes = sum(result["nodes"] for result in members)
+        seconds = sum(result["seconds"] for result in members)
+        summary[group] = {"nodes": nodes, "seconds": round(seconds, 4),
+                          "nodes_per_second": round(nodes / seconds) if seconds else 0}
+    return summary
+
+# Runs the search benchmark under cProfile
+# Params: positions, depth, mb, policy -> as search, top -> functions to list
+# Returns: the top functions by time spent in them, not counting what they call
+def profile(positions, depth, mb, top, policy="both"):
+    profiler = cProfile.Profile()
+    profiler.runcall(search, positions, depth, mb, 1, policy)
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    return [{"function": "%s:%d(%s)" % (filename.split("/")[-1], line, function),
+             "calls": calls, "tottime": round(tottime, 4), "cumtime": round(cumtime, 4)}
+            for (filename, line, function), (primitive, calls, tottime, cumtime, callers) in rows]
+
+# Params: results -> a run's results
+# Returns: dict of metric name -> (value, True if higher is better)
+def metrics(results):
+    found = {}
+    # Kernels are compared by their speed relative to reference()
+    for name, ops in results.get("relative", {}).items():
+        found["kernels." + name] = (ops, True)
+    for part in ("search", "solver"):
+        for group, totals in results.get(part, {}).items():
+            if group != "positions":
+                found["%s.%s.seconds" % (part, group)] = (totals["seconds"], False)
+                found["%s.%s.nodes_per_second" % (part, group)] = (totals["nodes_per_second"], True)
+    return found
+
+# Compare a run with a baseline
+# Params: results, baseline -> two runs' results, threshold -> share a number
+#         may get worse by before it's a regression, kernel_threshold -> the
+#         same for the kernels, which are noisier
+# Returns: list of (metric, old, new, change, regressed), change is the
+#          share it got better by, negative if it got worse
+def compare(results, baseline, threshold, kernel_threshold):
+    new = metrics(results)
+    old = metrics(baseline)
+    rows = []
+    for name in sorted(new.keys() & old.keys()):
+        value, higher = new[name]
+        before = old[name][0]
+        if not before or not value:
+            continue
+        change = value / before - 1 if higher else before / value - 1
+        limit = kernel_threshold if name.startswith("kernels.") else threshold
+        rows.append((name, before, value, change, change < -limit))
+    return rows
+
+# Print the results for people
+def report(results, rows, out):
+    for name, ops in results.get("kernels", {}).items():
+        print("%-16s %12.0f ops/s" % (name, ops), file=out)
+    for part in ("search", "solver"):
+        if part not in results:
+            continue
+        for result in results[part]["positions"]:
+            print("%-6s %-10s depth %-2s score %8s nodes %8d  %7.3fs  %6d nodes/s" % (
+                part, result["position"], result.get("depth", "-"), result["score"],
+                result["nodes"], result["seconds"], result["nodes_per_second"]), file=out)
+        for group in ("all",) + tuple(CORPUS):
+            totals = results[part].get(group)
+            if totals:
+                print("%-6s %-10s nodes %8d  %7.3fs  %6d nodes/s" % (
+                    part, group, totals["nodes"], totals["seconds"], totals["nodes_per_second"]),
+                    file=out)
+    if results.get("profile"):
+        print("%9s %9s %9s  %s" % ("tottime", "cumtime", "calls", "function"), file=out)
+    for row in results.get("profile", []):
+        print("%8.3fs %8.3fs %9d  %s" % (row["tottime"], row["cumtime"], row["calls"],
+                                        row["function"]), file=out)
+    if rows:
+        print("%-32s %12s    %12s  %7s" % ("metric", "baseline", "now", "better"), file=out)
+    for name, old, new, change, regressed in rows:
+        print("%-32s %12.4g -> %12.4g  %+6.1f%%%s" % (name, old, new, 100 * change,
+                                                      "  REGRESSION" if regressed else ""),
+              file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark agent.py")
+    parser.add_argument("--parts", nargs="+", choices=("kernels", "search", "solver"),
+                        default=["kernels", "search", "solver"],
+                        help="what to time (default all of them)")
+    parser.add_argument("--depth", type=int, default=8,
+                        help="depth to search each position to (default %(default)s)")
+    parser.add_argument("--seconds", type=float, default=0.2,
+                        help="seconds to time each kernel for, per round (default %(default)s)")
+    parser.add_argument("--rounds", type=int, default=15,
+                        help="rounds to time the kernels for, the median counts "
+                             "(default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="times to search each position, the fastest counts "
+                             "(default %(default)s)")
+    parser.add_argument("--hash", type=int, default=16,
+                        help="transposition table size in MB (default %(default)s)")
+    parser.add_argument("--tt-policy", choices=agent.TT_POLICIES, default=agent.TT_POLICIES[0],
+                        help="transposition table replacement policy, see agent.py --tt-policy "
+                             "(default %(default)s)")
+    parser.add_argument("--json", help="write the results to this file, - for stdout")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="how much worse than the baseline is a regression "
+                             "(default %(default)s, 10%%)")
+    parser.add_argument("--kernel-threshold", type=float, default=0.2,
+                        help="the same for the kernels (default %(default)s, 20%%)")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile the search and list the functions it spends longest in")
+    parser.add_argument("--top", type=int, default=15,
+                        help="functions to list with --profile (default %(default)s)")
+    args = parser.parse_args()
+
+    positions = corpus()
+    results = {"python": platform.python_version(), "depth": args.depth,
+               "tt_policy": args.tt_policy, "corpus": CORPUS}
+    if "kernels" in args.parts:
+        results["kernels"], results["relative"] = time_kernels(kernels(positions), args.seconds,
+                                                               args.rounds)
+    if "search" in args.parts:
+        results["search"] = search(positions, args.depth, args.hash, args.repeat, args.tt_policy)
+    if "solver" in args.parts:
+        results["solver"] = solver(positions, args.hash, args.repeat, args.tt_policy)
+    if args.profile:
+        results["profile"] = profile(positions, args.depth, args.hash, args.top, args.tt_policy)
+    rows = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows = compare(results, json.load(f), args.threshold, args.kernel_threshold)
+        results["regressions"] = [name for name, old, new, change, regressed in rows
+                                  if regressed]
+
+    # The report goes to stderr when the results go to stdout
+    report(results, rows, sys.stderr if args.json == "-" else sys.stdout)
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if results.get("regressions"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# Opening book builder for agent.py.
+# Searches every position up to --ply moves into the game to a fixed depth and
+# writes the best moves to a book file, which the agent mmaps at startup.
+# Symmetric positions are only searched once, see Symmetry in agent.py.
+#
+# Usage: ./book.py [--ply 3] [--depth 9] [--workers 4] [-o agent.book]
+
+import argparse
+import concurrent.futures
+import time
+
+import agent
+
+# Engine of this worker process, made by worker_init
+engine = None
+
+# Params: board -> board state, player -> player to see it as player 1
+# Returns: a copy of the board from that player's side
+def seen_by(board, player):
+    if player == 1:
+        return board.copy()
+    seen = agent.Board()
+    for p in (1, 2):
+        for i in range(1, 10):
+            for j in agent.EMPTY[511 ^ board.bits[p][i]]:
+                seen.make(i, j, 3 - p)
+    return seen
+
+# Finds every position that can come up in the first moves of a game.
+# The server makes the first move, so every position has at least one move.
+# Params: max_ply -> most moves made
+# Returns: dict of canonical key -> (board, boardnum), the canonical form
+#          seen by the player to move, who is player 1
+def early_positions(max_ply):
+    positions = {}
+
+    # player -> who moves next, boardnum -> board they play in
+    def visit(board, boardnum, player, ply):
+        seen = seen_by(board, player)
+        key, symmetry = seen.key(1, boardnum)
+        if key in positions:
+            return
+        positions[key] = (agent.transform(seen, symmetry), agent.SYMMETRY[symmetry][boardnum])
+        if ply == max_ply:
+            return
+        for cell in board.moves(boardnum):
+            board.make(boardnum, cell, player)
+            if not agent.checkWin(board, boardnum, player) and board.moves(cell):
+                visit(board, cell, 3 - player, ply + 1)
+            board.unmake(boardnum, cell, player)
+
+    board = agent.Board()
+    for first in range(1, 10):
+        for cell in range(1, 10):
+            board.make(first, cell, 1)
+            visit(board, cell, 2, 1)
+            board.unmake(first, cell, 1)
+    return positions
+
+# Set up a worker process
+# Params: mb -> transposition table size
+def worker_init(mb):
+    global engine
+    engine = agent.Engine(mb)
+
+# Searches one position with iterative deepening
+# Params: key -> canonical key, board -> canonical board, boardnum -> board to
+#         play in, depth -> depth to search to
+# Returns: book entry (key, score, move, depth)
+def search(key, board, boardnum, depth):
+    engine.tt.new_search()
+    engine.ordering.new_search()
+    for engine.depth_limit in range(1, depth + 1):
+        move, score = engine.search_root(board, boardnum)
+        if abs(score) >= agent.WIN:
+            break
+    return key, score, move, engine.depth_limit
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the opening book for agent.py")
+    parser.add_argument("--ply", type=int, default=3,
+                        help="book positions up to this many moves in (default %(default)s)")
+    parser.add_argument("--depth", type=int, default=9,
+                        help="search depth for each position (default %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes searching in parallel (default %(default)s)")
+    parser.add_argument("--hash", type=int, default=agent.TT_MB,
+                        help="transposition table size in MB, per process (default %(default)s)")
+    parser.add_argument("-o", dest="output", default=agent.BOOK_FILE,
+                        help="book file to write (default %(default)s)")
+    args = parser.parse_args()
+
+    positions = early_positions(args.ply)
+    print("%d positions up to ply %d" % (len(positions), args.ply))
+    start = time.time()
+    entries = []
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=worker_init,
+                                                initargs=(args.hash,)) as pool:
+        futures = [pool.submit(search, key, board, boardnum, args.depth)
+                   for key, (board, boardnum) in positions.items()]
+        for future in concurrent.futures.as_completed(futures):
+            entries.append(future.result())
+            if len(entries) % 100 == 0:
+                print("%d/%d searched, %.0fs" % (len(entries), len(positions), time.time() - start))
+    agent.write_book(args.output, entries)
+    print("wrote %d entries to %s in %.0fs" % (len(entries), args.output, time.time() - start))
+
+if __name__ == "__main__":
+    main()
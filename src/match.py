@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+# Self-play match runner for agent.py.
+# Plays two engines against each other in this process, no servt and no
+# sockets. Each agent file is loaded as a separate module, so two versions
+# of agent.py can play each other, and the runner talks to each side's
+# Engine and GameState through respond() with the same messages servt sends.
+# The runner keeps the clocks and checks moves the way servt.c does. Games
+# are spread over a process pool.
+#
+# Both sides get a new Engine and GameState for every game, as if servt had
+# started new agent processes. Every opening is played twice with the
+# engines swapping sides, and game n always gets the same opening for the
+# same --seed. With --record the first engine's games are written as game
+# records, self-play data for tune.py.
+#
+# Usage: ./match.py agent.py old_agent.py [-n 1000] [--workers 8] [-t 30 2]
+#        ./match.py agent.py agent.py --search pvs alphabeta
+#        ./match.py agent.py agent.py --search mcts pvs
+#        ./match.py agent.py agent.py --weights agent.weights -
+#        ./match.py agent.py agent.py --hash 1 --tt-policy depth both
+#        ./match.py agent.py agent.py -t 6 0.05 --record records
+
+import argparse
+import concurrent.futures
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+
+# Game results, as servt reports them
+WIN = "win"
+LOSS = "loss"
+DRAW = "draw"
+
+# Agent modules, transposition table size, clock, Engine options, the first
+# engine's Recorder and each side's mcts module (or None), set in each worker
+settings = None
+
+# Load an agent file as a module of its own
+# Params: path -> agent file, name -> module name to give it
+# Returns: the module
+def load_engine(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    engine = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(engine)
+    return engine
+
+# Load the mcts.py next to an agent file, with its "import agent" getting
+# that file's module, so an mcts side plays with its own agent file's tables
+# rather than whichever agent.py is first on the path
+# Params: module -> agent module from load_engine, name -> module name to give it
+# Returns: the mcts module
+def load_mcts(module, name):
+    saved = sys.modules.get("agent")
+    sys.modules["agent"] = module
+    try:
+        return load_engine(os.path.join(os.path.dirname(module.__file__), "mcts.py"), name)
+    finally:
+        if saved is None:
+            del sys.modules["agent"]
+        else:
+            sys.modules["agent"] = saved
+
+# Runs in each worker when it starts
+# Params: paths -> the two agent files, mb -> transposition table size,
+#         seconds -> (initial, per move) clock,
+#         options -> keyword arguments for each file's Engine, weights given
+#         as a file name, record -> directory for the first engine's game records
+def worker_init(paths, mb, seconds, options, record):
+    global settings
+    modules = [load_engine(path, "engine%d" % n) for n, path in enumerate(paths)]
+    options = [dict(kwargs) for kwargs in options]
+    for module, kwargs in zip(modules, options):
+        if "weights" in kwargs:
+            kwargs["weights"] = module.load_weights(kwargs["weights"])
+    recorder = modules[0].Recorder(record) if record else None
+    searchers = [load_mcts(module, "mcts%d" % n) if kwargs.get("search") == "mcts" else None
+                 for n, (module, kwargs) in enumerate(zip(modules, options))]
+    settings = (modules, mb, seconds, options, recorder, searchers)
+
+# Params: module -> agent module, kwargs -> its Engine options,
+#         searcher -> its mcts module from load_mcts, or None
+# Returns: a new Engine, or MctsEngine for --search mcts
+def new_search(module, kwargs, searcher):
+    if searcher is not None:
+        return searcher.MctsEngine()
+    # Agent files from before make_engine only have Engine
+    return getattr(module, "make_engine", module.Engine)(settings[1], **kwargs)
+
+# Returns: a new (module, GameState, Engine) for both agent files
+def new_engines():
+    modules, mb, seconds, options, recorder, searchers = settings
+    return [(module, module.GameState(*seconds, show_board=False,
+                                      **({"recorder": recorder} if n == 0 and recorder else {})),
+             new_search(module, kwargs, searcher))
+            for n, (module, kwargs, searcher) in enumerate(zip(modules, options, searchers))]
+
+# Pass a message to an engine, what it prints is thrown away
+# Params: engine -> (module, GameState, Engine), message -> line servt would send
+# Returns: what respond() returned
+def send(engine, message):
+    module, game, search = engine
+    with contextlib.redirect_stdout(io.StringIO()):
+        return module.respond(game, search, message)
+
+# Return True if player holds a line in the 3x3 board, as gamewon() in game.c
+def gamewon(player, cells):
+    return any(cells[a] == cells[b] == cells[c] == player for a, b, c in (
+        (1,2,3), (4,5,6), (7,8,9), (1,4,7), (2,5,8), (3,6,9), (1,5,9), (3,5,7)))
+
+# Play one game, the referee part of servt.c
+# Params: game -> game number, seed -> match seed
+# Returns: dict with the result for engine 0 and each engine's moves
+def play_game(game, seed):
+    # Openings come in pairs, the second game of a pair swaps the sides
+    rng = random.Random(seed * 1000003 + game // 2)
+    first = game % 2
+    engines = new_engines()
+    players = (engines[first], engines[1 - first])
+    seconds_initially, seconds_per_move = settings[2]
+    send(players[0], "init.")
+    send(players[1], "init.")
+    send(players[0], "start(x).")
+    send(players[1], "start(o).")
+    board = [[0] * 10 for i in range(10)]
+    move = [0] * 82
+    msec_left = [1000 * (seconds_initially - seconds_per_move)] * 2
+    stats = [[], []]
+
+    move[0] = 1 + rng.randrange(9)
+    move[1] = 1 + rng.randrange(9)
+    board[move[0]][move[1]] = 1
+    player = 0
+    status = None
+    m = 1
+    while status is None and m < 81:
+        m += 1
+        player = 1 - player
+        if m == 2:
+            message = "second_move(%d,%d)." % (move[0], move[1])
+        elif m == 3:
+            message = "third_move(%d,%d,%d)." % (move[0], move[1], move[2])
+        else:
+            message = "next_move(%d)." % move[m - 1]
+        msec_left[player] += 1000 * seconds_per_move
+        engine = players[player]
+        start = time.perf_counter()
+        reply = send(engine, message)
+        elapsed = time.perf_counter() - start
+        msec_left[player] -= 1 + int(elapsed * 1000)
+        stats[player].append((elapsed, engine[2].nodes))
+
+        if not isinstance(reply, int) or not 1 <= reply <= 9 or board[move[m - 1]][reply]:
+            status = ("illegal_move", 1 - player)
+            break
+        move[m] = reply
+        board[move[m - 1]][reply] = player + 1
+        if gamewon(player + 1, board[move[m - 1]]):
+            status = ("triple", player)
+        elif all(board[reply][1:]):
+            status = ("full_board", None)
+        elif msec_left[player] < 0:
+            status = ("timeout", 1 - player)
+    # servt tells the other side the move that won or filled the board
+    if status is not None and status[0] in ("triple", "full_board"):
+        send(players[1 - player], "last_move(%d)." % move[m])
+    if status is None:
+        status = ("full_board", None)
+
+    cause, winner = status
+    if winner is None:
+        result = DRAW
+        for engine in players:
+            send(engine, "draw(%s)." % cause)
+    else:
+        send(players[winner], "win(%s)." % cause)
+        send(players[1 - winner], "loss(%s)." % cause)
+        result = WIN if (winner == 0) == (first == 0) else LOSS
+    for engine in players:
+        send(engine, "end.")
+    # stats by engine rather than by side
+    if first:
+        stats.reverse()
+    return {"game": game, "result": result, "cause": cause, "moves": stats}
+
+# Params: wins, draws, losses -> results for engine 0
+# Returns: (elo, low, high) elo difference with a 95% confidence interval
+def elo(wins, draws, losses):
+    games = wins + draws + losses
+    score = (wins + draws / 2) / games
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2
+                + losses * score ** 2) / games
+    margin = 1.96 * math.sqrt(variance / games)
+
+    def to_elo(s):
+        s = min(max(s, 1e-6), 1 - 1e-6)
+        return -400 * math.log10(1 / s - 1)
+    return to_elo(score), to_elo(score - margin), to_elo(score + margin)
+
+# Params: values -> list of numbers, share -> 0 to 1
+# Returns: the value at that share of the sorted list
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(share * len(values)), len(values) - 1)]
+
+# Params: paths -> engine files, results -> play_game results
+# Returns: summary dict of the match
+def summarise(paths, results):
+    counts = {result: sum(1 for game in results if game["result"] == result)
+              for result in (WIN, DRAW, LOSS)}
+    elo_diff, low, high = elo(counts[WIN], counts[DRAW], counts[LOSS])
+    summary = {"games": len(results), "wins": counts[WIN], "draws": counts[DRAW],
+               "losses": counts[LOSS], "elo": elo_diff, "elo_low": low, "elo_high": high,
+               "causes": {}, "engines": []}
+    for game in results:
+        summary["causes"][game["cause"]] = summary["causes"].get(game["cause"], 0) + 1
+    for n, path in enumerate(paths):
+        moves = [move for game in results for move in game["moves"][n]]
+        seconds = sum(elapsed for elapsed, searched in moves)
+        searched = sum(searched for elapsed, searched in moves)
+        times = [elapsed for elapsed, searched in moves]
+        summary["engines"].append({
+            "path": path,
+            "moves": len(moves),
+            "nodes_per_second": searched / seconds if seconds else 0,
+            "move_seconds": {"mean": seconds / len(moves) if moves else 0,
+                             "p50": percentile(times, 0.5) if times else 0,
+                             "p90": percentile(times, 0.9) if times else 0,
+                             "p99": percentile(times, 0.99) if times else 0,
+                             "max": max(times) if times else 0}})
+    return summary
+
+# Print the summary for people
+def report(summary):
+    print("%d games: %d wins, %d draws, %d losses for %s" % (
+        summary["games"], summary["wins"], summary["draws"], summary["losses"],
+        summary["engines"][0]["path"]))
+    print("elo %+.1f (95%% %+.1f to %+.1f)" % (summary["elo"], summary["elo_low"],
+                                              summary["elo_high"]))
+    print("ended by " + ", ".join("%s %d" % item for item in sorted(summary["causes"].items())))
+    for engine in summary["engines"]:
+        times = engine["move_seconds"]
+        print("%s: %d moves, %.0f nodes/s, move time mean %.3fs p50 %.3fs p90 %.3fs "
+              "p99 %.3fs max %.3fs" % (engine["path"], engine["moves"], engine["nodes_per_second"],
+                                       times["mean"], times["p50"], times["p90"],
+                                       times["p99"], times["max"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Play two agent files against each other")
+    parser.add_argument("engines", nargs=2, help="agent files, results are for the first")
+    parser.add_argument("-n", dest="games", type=int, default=100,
+                        help="number of games, rounded up to a whole pair (default %(default)s)")
+    parser.add_argument("-t", dest="time", type=float, nargs=2, default=(30, 2),
+                        metavar=("initial", "permove"),
+                        help="seconds allowed initially and per move (default 30 2)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="games played at once, keep it at or below the cores (default %(default)s)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed for the openings (default %(default)s)")
+    parser.add_argument("--hash", type=int, default=16,
+                        help="transposition table size in MB per engine (default %(default)s)")
+    parser.add_argument("--search", nargs=2, choices=("pvs", "alphabeta", "mcts"),
+                        metavar=("first", "second"),
+                        help="search algorithm of each engine, pvs, alphabeta or mcts, "
+                             "which plays the mcts.py next to its agent file "
+                             "(default each file's own default)")
+    parser.add_argument("--tt-policy", nargs=2, choices=("both", "depth", "always"),
+                        metavar=("first", "second"),
+                        help="transposition table replacement policy of each engine, both, "
+                             "depth or always (default each file's own default)")
+    parser.add_argument("--weights", nargs=2, metavar=("first", "second"),
+                        help="heuristic weights file written by tune.py for each engine, "
+                             "- for the hand picked weights (default the hand picked weights)")
+    parser.add_argument("--record", metavar="DIR",
+                        help="write the first engine's games to DIR as game records")
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args()
+    options = [{"search": search} for search in args.search] if args.search else [{}, {}]
+    if args.tt_policy:
+        for kwargs, policy in zip(options, args.tt_policy):
+            kwargs["tt_policy"] = policy
+    if args.weights:
+        for kwargs, path in zip(options, args.weights):
+            kwargs["weights"] = None if path == "-" else path
+
+    games = args.games + args.games % 2
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(
+            args.workers, initializer=worker_init,
+            initargs=(args.engines, args.hash, tuple(args.time), options,
+                      args.record)) as pool:
+        futures = [pool.submit(play_game, game, args.seed) for game in range(games)]
+        for future in concurrent.futures.as_completed(futures):
+            results.append(future.result())
+            if len(results) % 10 == 0:
+                print("%d/%d games" % (len(results), games), file=sys.stderr)
+    results.sort(key=lambda game: game["game"])
+    summary = summarise(args.engines, results)
+    report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+# Monte Carlo tree search engine for agent.py, chosen with --search mcts.
+# Scalar playouts in Python are far too slow to be worth it (see the design
+# notes in agent.py), so playouts here run thousands at a time as NumPy
+# arrays. Each batch picks LEAVES leaves of the tree with UCT, and plays
+# PLAYOUTS random games from every one of them at once: legal moves, the
+# random choice and the win check are table lookups over the whole batch.
+#
+# The tree is kept between moves. After we move, the child we played
+# becomes the root, and when our next turn comes the grandchild for their
+# reply takes over, with everything searched below it so far.
+#
+# MctsEngine has the same methods as agent.Engine that respond() and
+# serve() use, so either can play a game. Needs numpy.
+
+import math
+import random
+import time
+
+import numpy as np
+
+import agent
+
+# Leaves chosen for each batch, and playouts from each of them
+LEAVES = 16
+PLAYOUTS = 16
+# UCT exploration constant, results are 1 for a win, 0.5 a draw and 0 a loss
+EXPLORATION = 1.0
+
+#########################################################################
+############################### Playouts ################################
+#########################################################################
+
+# Lookup tables over 9 bit masks of a 3x3 board, as in agent.py
+CELL = np.array(agent.CELL, dtype=np.uint16)
+WINNING = np.array(agent.WINNING, dtype=bool)
+POPCOUNT = np.array(agent.POPCOUNT, dtype=np.intp)
+# NTH_EMPTY[free][k] -> the k-th cell set in the mask free, 0 past the last
+NTH_EMPTY = np.zeros((512, 9), dtype=np.intp)
+for _free in range(512):
+    for _k, _cell in enumerate(agent.EMPTY[511 ^ _free]):
+        NTH_EMPTY[_free, _k] = _cell
+
+# WIN_CELL[mine][free] -> a cell of free that completes a line of mine, else 0.
+# Playouts take a win whenever there is one, which makes them far less
+# random about the endings than picking every move blindly.
+def build_win_cells():
+    mine = np.arange(512)[:, None]
+    free = np.arange(512)[None, :]
+    table = np.zeros((512, 512), dtype=np.intp)
+    for cell in range(9, 0, -1):
+        wins = WINNING[mine | agent.CELL[cell]] & (free & agent.CELL[cell] != 0)
+        table[wins] = cell
+    return table
+
+WIN_CELL = build_win_cells()
+
+# Plays random games to the end, all of them at once
+# Params: bits -> (games, 3, 10) masks, bits[g, p, i] as Board.bits[p][i],
+#         changed in place, boardnum -> (games,) board each game plays in next,
+#         player -> (games,) player to move, rng -> numpy Generator
+# Returns: (games,) the winner of each game, 0 for a draw
+def playouts(bits, boardnum, player, rng):
+    winner = np.zeros(len(boardnum), dtype=np.int8)
+    # Index into winner of the games still going
+    live = np.arange(len(boardnum))
+    while len(live):
+        rows = np.arange(len(live))
+        mine = bits[rows, player, boardnum]
+        free = 511 ^ (mine | bits[rows, 3 - player, boardnum])
+        # Sent to a full board, servt scores this as a draw
+        full = free == 0
+        cell = WIN_CELL[mine, free]
+        choice = (rng.random(len(live)) * POPCOUNT[free]).astype(np.intp)
+        cell = np.where(cell != 0, cell, NTH_EMPTY[free, choice])
+        mine |= CELL[cell]
+        bits[rows, player, boardnum] = mine
+        won = WINNING[mine] & ~full
+        winner[live[won]] = player[won]
+        going = ~(won | full)
+        live = live[going]
+        bits = bits[going]
+        boardnum = cell[going]
+        player = 3 - player[going]
+    return winner
+
+#########################################################################
+############################ End of Playouts ############################
+#########################################################################
+
+# A position in the tree, reached by player playing move.
+# wins counts the results of the playouts through it for player, visits
+# counts them all, and playouts still running count as visits with no
+# wins, so the leaves of one batch spread out over the tree.
+# result is player's result if the move ends the game, else None.
+class Node:
+    __slots__ = ("move", "player", "parent", "children", "untried", "visits", "wins",
+                 "result")
+
+    def __init__(self, move, player, parent):
+        self.move = move
+        self.player = player
+        self.parent = parent
+        self.children = []
+        self.untried = []
+        self.visits = 0
+        self.wins = 0.0
+        self.result = None
+
+class MctsEngine:
+
+    # Params: book -> Book or None, seed -> seed for the playouts, None for a random one
+    def __init__(self, book=None, seed=None):
+        self.book = book
+        self.rng = np.random.default_rng(seed)
+        self.order_rng = random.Random(seed)
+        # Tree kept from the last move, its root is the position after our
+        # move with them to play in root_boardnum
+        self.root = None
+        self.root_board = None
+        self.root_boardnum = 0
+        # Playouts this move, nodes added to the tree and batches run
+        self.nodes = 0
+        self.leaves = 0
+        self.batches = 0
+        self.search_info = {}
+
+    # Returns: what the last search found and its counters, for telemetry_record
+    def stats(self):
+        return dict(self.search_info, nodes=self.nodes, leaves=self.leaves, cutoffs=0,
+                    first_cutoffs=0, iterations=[])
+
+    # The batches are already vectorised, there's no root splitting
+    def start_pool(self, n):
+        pass
+
+    # There's no pondering, the tree is kept instead
+    def start_ponder(self, board, boardnum):
+        pass
+
+    # Returns: None, nothing was pondered
+    def stop_ponder(self, reply=0):
+        return None
+
+    # Finds which move to play, searching until the move's time is used up
+    # Params: board -> state of the 9x9 board, boardnum -> board we play in
+    #         move_start -> when the move was asked for, budget -> seconds from then
+    #         pondered -> unused, for respond()
+    # Returns: the cell to play
+    def choose_move(self, board, boardnum, move_start, budget, pondered=None):
+        self.nodes = 0
+        self.leaves = 0
+        self.batches = 0
+        # Take a win straight away, before the book
+        mine = board.bits[1][boardnum]
+        wins = agent.THREATS[mine] & ~(mine | board.bits[2][boardnum])
+        if wins:
+            self.search_info = {"source": "mcts", "score": 1.0, "depth": 1}
+            self.root = None
+            return agent.EMPTY[511 ^ wins][0]
+        entry = self.book.lookup(board, boardnum) if self.book else None
+        if entry:
+            self.search_info = {"source": "book", "score": entry[1], "depth": entry[2]}
+            self.root = None
+            return entry[0]
+        root = self.reuse(board, boardnum)
+
+        deadline = move_start + budget
+        batch_seconds = 0
+        while True:
+            started = time.time()
+            if root.children and started + batch_seconds > deadline:
+                break
+            # Every leaf UCT picked ends the game, the result is as good as known
+            if not self.batch(root, board, boardnum):
+                break
+            batch_seconds = time.time() - started
+        best = max(root.children, key=lambda child: child.visits)
+        self.search_info = {"source": "mcts", "score": round(best.wins / best.visits, 4),
+                            "depth": self.tree_depth(best)}
+        # Keep what's below our move for next time
+        best.parent = None
+        self.root = best
+        self.root_board = board.copy()
+        self.root_board.make(boardnum, best.move, 1)
+        self.root_boardnum = best.move
+        return best.move
+
+    # Params: board -> state of the 9x9 board, boardnum -> board we play in
+    # Returns: the root node for the position, from the kept tree if their
+    #          move was in it, else a new one
+    def reuse(self, board, boardnum):
+        old = self.root
+        self.root = None
+        if old is not None:
+            after = self.root_board
+            if not after.get(self.root_boardnum, boardnum):
+                after.make(self.root_boardnum, boardnum, 2)
+                if after.bits == board.bits:
+                    for child in old.children:
+                        if child.move == boardnum:
+                            child.parent = None
+                            return child
+        root = Node(0, 2, None)
+        root.untried = self.shuffled(board.moves(boardnum))
+        return root
+
+    # Returns: moves in a random order, the order they are added to the tree
+    def shuffled(self, moves):
+        moves = list(moves)
+        self.order_rng.shuffle(moves)
+        return moves
+
+    # Returns: how many moves deep the tree goes below node
+    def tree_depth(self, node):
+        depth = 0
+        level = [node]
+        while level:
+            level = [child for parent in level for child in parent.children]
+            depth += 1
+        return depth
+
+    # One batch: picks LEAVES leaves, plays PLAYOUTS games from each and adds
+    # the results up the tree
+    # Params: root -> root node, board -> its position, boardnum -> board we play in
+    # Returns: number of playouts, 0 if every leaf picked ends the game
+    def batch(self, root, board, boardnum):
+        leaves = []
+        states = []
+        for k in range(LEAVES):
+            node, position, move = self.select(root, board.copy(), boardnum)
+            if node.result is not None:
+                mover = PLAYOUTS * node.result
+                other = PLAYOUTS - mover
+                self.backup(node, *((mover, other) if node.player == 1 else (other, mover)))
+                continue
+            leaves.append(node)
+            states.append((position.bits[1], position.bits[2], move, 3 - node.player))
+        self.batches += 1
+        if not leaves:
+            return 0
+        bits = np.zeros((len(leaves), 3, 10), dtype=np.uint16)
+        bits[:, 1] = [state[0] for state in states]
+        bits[:, 2] = [state[1] for state in states]
+        boardnum = np.array([state[2] for state in states], dtype=np.intp)
+        player = np.array([state[3] for state in states], dtype=np.intp)
+        winner = playouts(np.repeat(bits, PLAYOUTS, axis=0), np.repeat(boardnum, PLAYOUTS),
+                          np.repeat(player, PLAYOUTS), self.rng).reshape(len(leaves), PLAYOUTS)
+        self.nodes += winner.size
+        ones = (winner == 1).sum(axis=1)
+        twos = (winner == 2).sum(axis=1)
+        for node, one, two in zip(leaves, ones.tolist(), twos.tolist()):
+            draws = PLAYOUTS - one - two
+            self.backup(node, one + draws / 2, two + draws / 2)
+        return winner.size
+
+    # Walks down the tree with UCT and adds a child to the node it stops at.
+    # Every node on the way gets PLAYOUTS visits now, so the next leaf of the
+    # batch goes elsewhere, and their results are added by backup().
+    # Params: root -> root node, board -> copy of its position, changed,
+    #         boardnum -> board played in next at the root
+    # Returns: the leaf, its position and the board played in next there
+    def select(self, root, board, boardnum):
+        node = root
+        node.visits += PLAYOUTS
+        while node.result is None:
+            if node.untried:
+                move = node.untried.pop()
+                child = Node(move, 3 - node.player, node)
+                board.make(boardnum, move, child.player)
+                if agent.WINNING[board.bits[child.player][boardnum]]:
+                    child.result = 1.0
+                elif not board.moves(move):
+                    # Sent to a full board, servt scores this as a draw
+                    child.result = 0.5
+                else:
+                    child.untried = self.shuffled(board.moves(move))
+                node.children.append(child)
+                self.leaves += 1
+                child.visits += PLAYOUTS
+                return child, board, move
+            explore = EXPLORATION * math.sqrt(math.log(node.visits))
+            node = max(node.children,
+                       key=lambda child: child.wins / child.visits + explore / math.sqrt(child.visits))
+            node.visits += PLAYOUTS
+            board.make(boardnum, node.move, node.player)
+            boardnum = node.move
+        return node, board, boardnum
+
+    # Adds playout results from a leaf to it and everything above it
+    # Params: node -> leaf, one, two -> results for player 1 and player 2
+    def backup(self, node, one, two):
+        while node is not None:
+            node.wins += one if node.player == 1 else two
+            node = node.parent
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# Reads the game records agent.py writes (see Game Records in agent.py).
+# A file or a directory of files is memory mapped as NumPy structured
+# arrays, one per file, so nothing is read until it's used and going
+# through millions of positions copies none of them.
+#
+#   records = record.load("records")
+#   for batch in record.batches(records, 100000):
+#       ours = batch[batch["player"] == 1]
+#       positions = record.bits(ours)
+#
+# Run on its own it prints a summary of the records. Needs numpy.
+#
+# Usage: ./record.py [records]
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+import agent
+
+# One record, the fields of agent.RECORD, mine is player 1's bits (us)
+# and theirs player 2's
+RECORD_DTYPE = np.dtype([
+    ("game", "<u8"),
+    ("mine", "<u2", (9,)),
+    ("theirs", "<u2", (9,)),
+    ("board", "u1"),
+    ("cell", "u1"),
+    ("player", "u1"),
+    ("ply", "u1"),
+    ("source", "u1"),
+    ("depth", "u1"),
+    ("result", "u1"),
+    ("unused", "u1"),
+    ("score", "<i4"),
+    ("nodes", "<u4"),
+    ("seconds", "<f4"),
+])
+assert RECORD_DTYPE.itemsize == agent.RECORD.size
+assert RECORD_DTYPE.fields["result"][1] == agent.RECORD_RESULT
+
+# Map one record file
+# Params: path -> file written by agent.py
+# Returns: array of its records, read only. A record cut short by the agent
+#          stopping part way through writing it is left out.
+def load_file(path):
+    with open(path, "rb") as f:
+        header = f.read(agent.RECORD_HEADER.size)
+    magic, size = agent.RECORD_HEADER.unpack(header)
+    if magic != agent.RECORD_MAGIC or size != RECORD_DTYPE.itemsize:
+        raise ValueError(path + " is not a game record file")
+    count = (os.path.getsize(path) - agent.RECORD_HEADER.size) // size
+    if not count:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=agent.RECORD_HEADER.size,
+                     shape=(count,))
+
+# Map a record file, or every .rec file in a directory
+# Params: path -> file or directory
+# Returns: list of arrays, one per file, oldest file first
+def load(path):
+    if not os.path.isdir(path):
+        return [load_file(path)]
+    names = sorted(name for name in os.listdir(path) if name.endswith(".rec"))
+    return [load_file(os.path.join(path, name)) for name in names]
+
+# Go through the records in slices of the mapped files, no copies are made
+# Params: records -> load(), size -> most records per slice
+# Returns: generator of record arrays
+def batches(records, size):
+    for array in records:
+        for start in range(0, len(array), size):
+            yield array[start:start + size]
+
+# Params: records -> record array
+# Returns: (records, 3, 10) uint16 array of the positions before each move,
+#          laid out as Board.bits, [n, p, i] is player p's mask of board i
+def bits(records):
+    positions = np.zeros((len(records), 3, 10), dtype=np.uint16)
+    positions[:, 1, 1:] = records["mine"]
+    positions[:, 2, 1:] = records["theirs"]
+    return positions
+
+# Params: records -> record array
+# Returns: float array, each record's game result for the player who made
+#          the move, 1 a win, 0.5 a draw and 0 a loss, NaN if it never finished
+def results(records):
+    ours = np.array([np.nan, 1.0, 0.5, 0.0])[records["result"]]
+    return np.where(records["player"] == 1, ours, 1 - ours)
+
+# Rebuild a position as a Board
+# Params: record -> one record
+# Returns: (board, boardnum) before the move, boardnum is the board it was played in
+def board(record):
+    position = agent.Board()
+    for p, field in ((1, "mine"), (2, "theirs")):
+        for i in range(1, 10):
+            for j in agent.EMPTY[511 ^ int(record[field][i - 1])]:
+                position.make(i, j, p)
+    return position, int(record["board"])
+
+# Print a summary of the records for people
+def report(records, out):
+    total = sum(len(array) for array in records)
+    print("%d files, %d records" % (len(records), total), file=out)
+    if not total:
+        return
+    games = np.unique(np.concatenate([array["game"] for array in records]))
+    print("%d games" % len(games), file=out)
+    # Every game has one record at ply 0, the first move
+    first = np.concatenate([array[array["ply"] == 0] for array in records])
+    counts = np.bincount(first["result"], minlength=4)
+    print("%d wins, %d draws, %d losses, %d unfinished" % (
+        counts[agent.RECORD_WIN], counts[agent.RECORD_DRAW], counts[agent.RECORD_LOSS],
+        counts[agent.RECORD_UNFINISHED]), file=out)
+    sources = np.zeros(len(agent.RECORD_SOURCES), dtype=np.int64)
+    depth = seconds = 0.0
+    searched = 0
+    for batch in batches(records, 1 << 20):
+        ours = batch[batch["player"] == 1]
+        sources += np.bincount(ours["source"], minlength=len(sources))
+        found = ours[ours["source"] != 0]
+        searched += len(found)
+        depth += found["depth"].sum(dtype=np.float64)
+        seconds += found["seconds"].sum(dtype=np.float64)
+    print("our moves by source: " + ", ".join(
+        "%s %d" % (name or "servt", count)
+        for name, count in zip(agent.RECORD_SOURCES, sources) if count), file=out)
+    if searched:
+        print("mean depth %.1f, mean %.3fs a move" % (depth / searched, seconds / searched),
+              file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise agent.py's game records")
+    parser.add_argument("path", nargs="?", default=agent.RECORD_DIR,
+                        help="record file or directory (default %(default)s)")
+    args = parser.parse_args()
+    report(load(args.path), sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+# Tunes the heuristic's weights (see Heuristic in agent.py) to the results
+# of recorded games, Texel style. Every position of every finished game is
+# scored by the heuristic, and the weights are fitted so that
+# sigmoid(k * score) predicts the game's result for player 1 (us): 1 a win,
+# 0.5 a draw, 0 a loss, by least squares. k is fitted first with the hand
+# picked weights and then kept, so the tuned weights are on the same scale.
+#
+# Scoring a position one at a time with calc_h is far too slow for this, so
+# the heuristic's features are worked out for every position at once with
+# NumPy table lookups, and cached next to the records. Scoring all of them
+# is then one matrix product, and each step of the fit a few more.
+#
+# Positions where the player to move can win the board straight away are
+# left out, the search never scores those with the heuristic. The games are
+# split by id, one in VALIDATION_SHARE kept out of the fit to check it on.
+# The weights are written as ints, --scale times the hand picked ones.
+#
+# Usage: ./tune.py [records] [-o agent.weights]
+#        ./match.py agent.py agent.py --weights agent.weights -
+# Needs numpy.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+import agent
+import record
+
+# Share of the games kept out of the fit
+VALIDATION_SHARE = 10
+# Positions whose features are worked out at once
+BATCH = 1 << 20
+# Stop fitting once an iteration improves the error by less than this
+TOLERANCE = 1e-10
+# Range fit_k searches. A k at either end means the scores say next to
+# nothing about the results, too few games or too many of one result,
+# and the fitted weights would be blown up to make up for it.
+K_RANGE = (1e-4, 10.0)
+
+#########################################################################
+############################### Features ################################
+#########################################################################
+
+# Lookup tables over 9 bit masks of a 3x3 board, as in agent.py
+THREATS = np.array(agent.THREATS, dtype=np.uint16)
+
+# TWOS[mine][theirs] -> agent.count_twos(mine, theirs), ways mine can win the board
+def build_twos():
+    mine = np.arange(512)[:, None]
+    theirs = np.arange(512)[None, :]
+    popcount = np.array(agent.POPCOUNT)
+    table = np.zeros((512, 512), dtype=np.int8)
+    for line in agent.LINES:
+        table += (theirs & line == 0) & (popcount[mine & line] == 2)
+    return table
+
+TWOS = build_twos()
+
+# The heuristic's features, the vectorised calc_h
+# Params: mine, theirs -> (n, 9) masks of player 1 and player 2 in boards 1..9
+# Returns: (n, len(agent.HEURISTIC_FEATURES)) int16 array of the features
+def features(mine, theirs):
+    us_ways = TWOS[mine, theirs]
+    them_ways = TWOS[theirs, mine]
+    us = us_ways.sum(axis=1, dtype=np.int16)
+    them = them_ways.sum(axis=1, dtype=np.int16)
+    us_boards = (us_ways > 0).sum(axis=1, dtype=np.int16)
+    them_boards = (them_ways > 0).sum(axis=1, dtype=np.int16)
+    return np.stack([us * us_boards, them * them_boards, us, them, us_boards, them_boards,
+                     np.ones_like(us)], axis=1)
+
+# Params: features -> from features(), weights -> one for each feature
+# Returns: the heuristic score of every position, what calc_h gives
+def evaluate(features, weights):
+    return features @ np.asarray(weights, dtype=np.float64)
+
+# Params: records -> record array
+# Returns: bool array, True for the records to tune on: finished games,
+#          where the player to move can't win the board straight away
+def quiet(records):
+    rows = np.arange(len(records))
+    board = records["board"].astype(np.intp) - 1
+    mine = records["mine"][rows, board]
+    theirs = records["theirs"][rows, board]
+    mover = np.where(records["player"] == 1, mine, theirs)
+    threats = THREATS[mover] & ~(mine | theirs)
+    return (records["result"] != agent.RECORD_UNFINISHED) & (threats == 0)
+
+# Works out the features of every position to tune on
+# Params: records -> record.load()
+# Returns: (features, results, games), results for player 1 and each
+#          position's game id
+def extract(records):
+    parts = []
+    for batch in record.batches(records, BATCH):
+        batch = batch[quiet(batch)]
+        ours = np.array([np.nan, 1.0, 0.5, 0.0], dtype=np.float32)[batch["result"]]
+        parts.append((features(batch["mine"], batch["theirs"]), ours, batch["game"]))
+    if not parts:
+        return (np.zeros((0, len(agent.HEURISTIC_FEATURES)), dtype=np.int16),
+                np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.uint64))
+    return tuple(np.concatenate(part) for part in zip(*parts))
+
+# extract(), from the cache when it was made from the same record files
+# Params: path -> records file or directory, cache -> .npz file for the features
+# Returns: as extract()
+def load_features(path, cache):
+    names = [path]
+    if os.path.isdir(path):
+        names = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                 if name.endswith(".rec")]
+    sources = np.array(["%s %d" % (os.path.basename(name), os.path.getsize(name))
+                        for name in names])
+    if os.path.exists(cache):
+        saved = np.load(cache)
+        if np.array_equal(saved["sources"], sources):
+            return saved["features"], saved["results"], saved["games"]
+    found = extract(record.load(path))
+    np.savez(cache, sources=sources, features=found[0], results=found[1], games=found[2])
+    return found
+
+# Checks features() against calc_h on some of the records, so the two can't
+# drift apart
+# Params: records -> record.load(), count -> records to check
+def check(records, count=200):
+    for batch in record.batches(records, count):
+        found = features(batch["mine"], batch["theirs"])
+        for entry, row in zip(batch, found):
+            board = record.board(entry)[0]
+            for weights in np.eye(len(agent.HEURISTIC_FEATURES), dtype=int).tolist():
+                if evaluate(row, weights) != agent.calc_h(board, tuple(weights)):
+                    raise AssertionError("tune.features() doesn't match agent.calc_h()")
+        return
+
+#########################################################################
+########################### End of Features #############################
+#########################################################################
+
+#########################################################################
+################################ Fitting ################################
+#########################################################################
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+# Params: scores -> heuristic scores, results -> as extract(),
+#         k -> scale of the scores in the sigmoid
+# Returns: mean squared error of sigmoid(k * score) against the results
+def score_error(scores, results, k):
+    return float(np.mean((results - sigmoid(k * scores)) ** 2))
+
+# Params: features, results -> as extract(), weights -> one for each feature, k -> as above
+# Returns: the error of the weights
+def error(features, results, weights, k):
+    return score_error(evaluate(features, weights), results, k)
+
+# Finds the k that fits the weights best, a golden section search over log k
+# Params: as error()
+# Returns: k
+def fit_k(features, results, weights):
+    scores = evaluate(features, weights)
+    low, high = np.log(K_RANGE[0]), np.log(K_RANGE[1])
+    ratio = (np.sqrt(5) - 1) / 2
+    for i in range(40):
+        a = high - ratio * (high - low)
+        b = low + ratio * (high - low)
+        if score_error(scores, results, np.exp(a)) < score_error(scores, results, np.exp(b)):
+            high = b
+        else:
+            low = a
+    return float(np.exp((low + high) / 2))
+
+# Fits the weights with k kept fixed, damped Gauss-Newton (Levenberg-Marquardt)
+# on the squared error. There are only a handful of weights, so every step
+# solves a small linear system built from one pass over the positions.
+# Params: as error(), weights -> where to start, iterations -> most steps
+# Returns: the fitted weights
+def fit(features, results, weights, k, iterations=100):
+    x = features.astype(np.float64)
+    y = results.astype(np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    damping = 1e-3
+    p = sigmoid(k * (x @ weights))
+    best = np.mean((y - p) ** 2)
+    for i in range(iterations):
+        # Jacobian of the predictions is k * p * (1 - p) * x
+        jacobian = x * (k * p * (1 - p))[:, None]
+        normal = jacobian.T @ jacobian
+        gradient = jacobian.T @ (y - p)
+        while damping < 1e10:
+            step = np.linalg.solve(normal + damping * np.diag(np.diag(normal) + 1e-12), gradient)
+            trial = sigmoid(k * (x @ (weights + step)))
+            found = np.mean((y - trial) ** 2)
+            if found < best:
+                break
+            damping *= 4
+        else:
+            break
+        weights = weights + step
+        p = trial
+        improved = best - found
+        best = found
+        damping = max(damping / 4, 1e-9)
+        if improved < TOLERANCE:
+            break
+    return weights
+
+#########################################################################
+############################ End of Fitting #############################
+#########################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the heuristic's weights to game records")
+    parser.add_argument("path", nargs="?", default=agent.RECORD_DIR,
+                        help="record file or directory (default %(default)s)")
+    parser.add_argument("-o", dest="output", default=agent.WEIGHTS_FILE,
+                        help="weights file to write (default %(default)s)")
+    parser.add_argument("--scale", type=int, default=16,
+                        help="weights are written as ints, this many times the size of "
+                             "the hand picked ones (default %(default)s)")
+    parser.add_argument("--cache",
+                        help="features cache (default features.npz in the records directory)")
+    args = parser.parse_args()
+    cache = args.cache or (os.path.join(args.path, "features.npz") if os.path.isdir(args.path)
+                           else args.path + ".npz")
+
+    started = time.time()
+    records = record.load(args.path)
+    check(records)
+    found, results, games = load_features(args.path, cache)
+    if not len(found):
+        sys.exit("no finished games in " + args.path)
+    validation = games % VALIDATION_SHARE == 0
+    train = (found[~validation], results[~validation])
+    held = (found[validation], results[validation])
+    print("%d positions, %d held out, features in %.1fs" % (
+        len(found), len(held[0]), time.time() - started))
+
+    hand = np.array(agent.HEURISTIC_WEIGHTS, dtype=np.float64)
+    k = fit_k(*train, hand)
+    if not K_RANGE[0] * 1.01 < k < K_RANGE[1] / 1.01:
+        sys.exit("k %g is at the end of its range, the records don't say enough "
+                 "about the results to fit to" % k)
+    started = time.time()
+    weights = fit(*train, hand, k)
+    print("k %.5f, fitted in %.1fs" % (k, time.time() - started))
+    tuned = np.round(weights * args.scale).astype(int)
+
+    print("%-18s %8s %8s %8s" % ("feature", "hand", "fitted", "written"))
+    for name, a, b, c in zip(agent.HEURISTIC_FEATURES, hand, weights, tuned):
+        print("%-18s %8g %8.3f %8d" % (name, a, b, c))
+    fits = {}
+    for name, w in (("hand", hand), ("fitted", weights), ("written", tuned / args.scale)):
+        fits[name] = [error(*train, w, k), error(*held, w, k) if len(held[0]) else None]
+        print("%-8s error %.5f, held out %s" % (
+            name, fits[name][0], "%.5f" % fits[name][1] if len(held[0]) else "-"))
+
+    try:
+        agent.write_weights(args.output, tuned.tolist(), args.scale, {
+            "k": k, "positions": int(len(found)), "error": fits["written"][0],
+            "held_out_error": fits["written"][1], "hand_picked_error": fits["hand"][0]})
+    except ValueError as e:
+        sys.exit("not written, %s" % e)
+    print("wrote " + args.output)
+
+if __name__ == "__main__":
+    main()